@@ -1,24 +1,105 @@
-from datetime import datetime, timedelta
-import random
+import argparse
+from datetime import datetime
+import math
+import os
 import tkinter as tk
 from tkinter import simpledialog
-import numpy as np
-import pandas as pd
-import unittest
+from engine import GameSession
+
+# Startup only imports what the username dialog and the first problem need. numpy, pandas and the modules built on them (storage, telemetry, decks, the scheduler and the problem index) are imported where they are first used, so the player is not kept waiting for them, see README.md for how the startup time is checked
 
 # Location to save score history
 scores_folder = "./data"
+# How to save score history: "csv" keeps one CSV file per user, "sqlite" keeps every user in one database that many game windows can share, see storage.py
+score_backend = "csv"
+# Location to cache generated problem decks, such as the daily challenge, see decks.py
+decks_folder = "./data/decks"
+# Location to save the per-answer telemetry (problem, correctness and response time of every answer), see telemetry.py
+telemetry_folder = "./data/telemetry"
+# Location to cache the index of every possible problem, used to avoid repeating problems within a game, see problem_index.py
+index_folder = "./data/index"
+# Location to keep the score sketches that percentile ranks are read from, see percentiles.py
+percentiles_folder = "./data/percentiles"
+# Fraction of problems that are missed problems coming back for review once they are due, when review is on, see review.py
+review_fraction = 0.25
+# Location to dump the timing histograms and answer counters to when instrumentation is on, see instrument.py
+instrument_folder = "./data/instrument"
 
 
 class UltraMac:
     # Time limit is in seconds, set to 20 for faster testing, normally set to 120 for players
-    def __init__(self, username, game_root, font="Arial", font_size=20, time_limit=20):
-        # Store scores and user data using username
+    # Pass a seed to replay the exact same problems, or problems (such as a DeckSource) to serve a fixed deck
+    # With adaptive=True, problem types are picked based on how this user has done on each type before, see scheduler.py
+    # With expression_depth, problems are random expression trees of that depth instead, see expressions.py
+    # With no_repeats=True, problems are drawn from the problem index so that none repeats within the game
+    # With review=True, problems this user got wrong come back later in this and future games until they are learned. Only for games with the problem templates, not with problems or expression_depth
+    # With auto_advance=True, the next problem comes up as soon as the typed answer is right, without pressing Enter
+    # Pass the Recorder returned by instrument.enable as recorder to dump its measurements at the end of the game
+    def __init__(
+        self,
+        username,
+        game_root,
+        font="Arial",
+        font_size=20,
+        time_limit=20,
+        store=None,
+        seed=None,
+        problems=None,
+        adaptive=False,
+        expression_depth=None,
+        no_repeats=False,
+        auto_advance=False,
+        review=False,
+        recorder=None,
+    ):
+        # Store scores and user data using username, the store is opened by score_store when the first score is saved
+        self.store = store
+        # Sketches of every player's scores for percentile ranks, loaded by score_distribution when the first score is saved
+        self.distribution = None
+        # (window name, rank, games) of the final score, set by save_score
+        self.ranks = []
         self.font = font
         self.font_size = font_size
         self.game_root = game_root
         self.username = username
         self.time_limit = time_limit  # in seconds
+        # Expression games are scored differently from template games, so each depth keeps its own score history, leaderboard and percentile sketches in a subfolder
+        self.game_folder = ""
+        if expression_depth is not None:
+            self.game_folder = f"expressions-depth{expression_depth}"
+        self.recorder = recorder
+        scheduler = None
+        if adaptive:
+            from scheduler import load_stats
+
+            scheduler = load_stats(scores_folder, username)
+        index = None
+        if no_repeats:
+            from problem_index import load_index
+
+            index = load_index(index_folder)
+        review_queue = None
+        if review:
+            from review import load_review
+
+            review_queue = load_review(scores_folder, username, review_fraction)
+        # The game rules and state live in a headless GameSession, this class only adapts it to Tkinter
+        self.session = GameSession(
+            username=username,
+            time_limit=time_limit,
+            seed=seed,
+            problems=problems,
+            scheduler=scheduler,
+            expression_depth=expression_depth,
+            index=index,
+            review=review_queue,
+        )
+        self.refill_scheduled = False
+        self.auto_advance = auto_advance
+        # Label texts waiting for the next refresh, and the texts the labels show now, see set_text
+        self.pending_text = {}
+        self.shown_text = {}
+        self.refresh_scheduled = False
 
         # Create UI elements with padding to look pretty
         self.game_root.title("UltraMac")
@@ -42,12 +123,19 @@ class UltraMac:
         self.button_start.pack(pady=10)
         self.button_start.bind("<Return>", self.start_game)
         self.button_start.focus_set()
+        # Fill the problem queue while the player is looking at the start button
+        self.schedule_refill()
 
     def start_game(self, event=None):
-        self.end_time = datetime.now() + timedelta(seconds=self.time_limit)
-        self.score = 0
+        # By now the idle refills have imported numpy, which the answer log needs
+        from telemetry import AnswerLog
+
+        self.session.answer_log = AnswerLog(
+            telemetry_folder, self.username, self.session.seed
+        )
+        self.session.start()
         # Update UI now that game is starting
-        self.label_timer.config(text=f"Time: {self.time_limit}")
+        self.set_text(self.label_timer, f"Time: {self.time_limit}")
         self.button_start.destroy()
         self.label_question = tk.Label(
             self.game_root, text="Solve: ", font=(self.font, self.font_size)
@@ -55,397 +143,169 @@ class UltraMac:
         self.label_question.pack(pady=5)
         # Load first problem into UI
         self.update_problem()
-        self.entry_answer = tk.Entry(self.game_root, font=(self.font, self.font_size))
+        self.answer_text = tk.StringVar(self.game_root)
+        self.entry_answer = tk.Entry(
+            self.game_root,
+            font=(self.font, self.font_size),
+            textvariable=self.answer_text,
+        )
         self.entry_answer.pack(pady=5)
+        # Enter still submits any answer, auto-advance only adds a check on every change to the text
         self.entry_answer.bind("<Return>", self.check_answer)
+        if self.auto_advance:
+            self.answer_text.trace_add("write", self.check_typed)
         self.entry_answer.pack(pady=5)
         self.entry_answer.focus_set()
         # Start timer
-        self.game_root.after(1000, self.check_timer)
+        self.schedule_tick()
+
+    def schedule_refill(self):
+        # Top up the session's problem queue one chunk at a time once Tk has nothing else to do, so the next problem is always ready before Enter is pressed
+        if self.session.problems.needs_refill() and not self.refill_scheduled:
+            self.refill_scheduled = True
+            self.game_root.after_idle(self.refill_problems)
+
+    def refill_problems(self):
+        self.refill_scheduled = False
+        self.session.problems.refill()
+        self.schedule_refill()
+
+    def set_text(self, label, text):
+        # Change a label's text at the next refresh. However many changes happen before then (a tick, a new score and a new problem), Tk gets one refresh, and only labels whose text actually changed are touched
+        if self.shown_text.get(label) == text:
+            self.pending_text.pop(label, None)
+            return
+        self.pending_text[label] = text
+        if not self.refresh_scheduled:
+            self.refresh_scheduled = True
+            self.game_root.after_idle(self.refresh)
+
+    def refresh(self):
+        self.refresh_scheduled = False
+        for label, text in self.pending_text.items():
+            label.config(text=text)
+            self.shown_text[label] = text
+        self.pending_text.clear()
 
     def update_problem(self):
-        # Update the problem in the UI
-        self.label_timer.config(
-            text=f"Time: {(self.end_time - datetime.now()).seconds}"
-        )
-        self.problem_string, self.solution, self.problem_score = self.generate_problem()
-        self.label_question.config(text=f"Solve: {self.problem_string}")
+        # Update the problem in the UI with the session's current problem, the timer is kept up to date by check_timer
+        self.set_text(self.label_question, f"Solve: {self.session.problem_string}")
 
     def generate_problem(self):
-        # Generate a random quick math problem
+        # Generate a random quick math problem, see problems.py for how the problem types, bounds and scores are defined
         # Compound problems consist of multiple operations, which is not a feature that ZetaMac includes. So, this is a signfiicant upgrade we did, since it allows for substantially more challenging mental math (while each individual operation should still be simple enough to do in one's head).
-        # The base problems (consisting of just one operation) are designed to be approximately of similar difficulty in terms of mental math, so that they are all worth the same score. We do this by adjusting the upper bounds of the random numbers that are generated for each operation so that the difficulty is similar. Ex: Addition has a larger upper bound than multiplication, since multiplication is more difficult. Similarly, exponentiation has a smaller upper bound than multiplication, since exponentiation is more difficult.
-        # We reward a higher score for compound problems, since they are more difficult. We increase score by one for each operation in the compound problem. So, a compound problem with 3 operations is worth 3 points, and a compound problem with 2 operations is worth 2 points.
-        # For all the problems that involve subtraction, we want to ensure that the result is non-negative. So, we sometimes sort the numbers in descending order so smaller number gets subtracted from bigger number. Other times, we set the upper bound to be whatever the expression is that we are subtracting from.
-        # For division, we want to ensure that the result is an integer, so we multiply two numbers together to get a bigger number that is for sure divisible by the second number. The logic behind ensuring that the result is an integer is tricky, so we do not include division when creating compound problems.
-        # We also do not include exponentiation when creating compound problems because they would be generally infeasible to solve using mental math in compound problems.
-        problem_types = [
-            "addition",
-            "subtraction",
-            "multiplication",
-            "division",
-            "exponentiation",
-            "compound_add_then_multiply",
-            "compound_multiply_then_add",
-            "compound_add_then_subtract",
-            "compound_subtract_then_add",
-            "compound_subtract_then_multiply",
-            "compound_multiply_then_subtract",
-            "compound_add_then_add",
-            "compound_multiply_then_multiply",
-            "compound_add_then_add_then_add",
-            "compound_multiply_then_multiply_then_multiply",
-            "compound_add_then_subtract_then_multiply",
-            "compound_subtract_then_add_then_multiply",
-            "compound_add_then_add_then_subtract",
-            "compound_subtract_then_add_then_add",
-            "compound_subtract_then_multiply_then_add",
-            "compound_multiply_then_subtract_then_add",
-            "compound_multiply_then_multiply_then_subtract",
-            "compound_multiply_then_subtract_then_multiply",
-            "compound_subtract_then_multiply_then_multiply",
-            "compound_subtract_then_multiply_then_subtract",
-            "compound_add_then_multiply_then_add",
-            "compound_add_then_multiply_then_subtract",
-            "compound_add_then_subtract_then_multiply",
-            "compound_add_then_subtract_then_add",
-            "compound_multiply_then_add_then_multiply",
-            "compound_multiply_then_add_then_add",
-            "compound_multiply_then_subtract_then_multiply",
-            "compound_multiply_then_subtract_then_add",
-            "compound_subtract_then_add_then_multiply",
-            "compound_subtract_then_add_then_subtract",
-            "compound_subtract_then_multiply_then_add",
-            "compound_subtract_then_multiply_then_subtract",
-        ]
-        lower_bound = 1
-        upper_bound = 36
-        problem_type = random.choice(problem_types)
-        if problem_type == "addition":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound, size=2)
-            solution = x + y
-            problem_string = f"{x} + {y} = "
-        elif problem_type == "subtraction":
-            x, y = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=2),
-                reverse=True,
-            )  # Ensure non-negative result
-            solution = x - y
-            problem_string = f"{x} - {y} = "
-        elif problem_type == "multiplication":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound // 3, size=2)
-            solution = x * y
-            problem_string = f"{x} x {y} = "
-        elif problem_type == "division":
-            x, y = np.random.randint(low=1, high=upper_bound // 3, size=2)
-            x *= y  # Ensure integer result
-            solution = x // y
-            problem_string = f"{x} / {y} = "
-        elif problem_type == "exponentiation":
-            x = np.random.randint(2, 10, size=1)[0]
-            if x >= 5:
-                y = np.random.randint(2, 3, size=1)[0]
-            else:
-                y = np.random.randint(3, 5, size=1)[0]
-            solution = x**y
-            problem_string = f"{x} ^ {y} = "
-        elif problem_type == "compound_add_then_multiply":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound, size=2)
-            z = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            solution = (x + y) * z
-            problem_string = f"({x} + {y}) x {z} = "
-        elif problem_type == "compound_multiply_then_add":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound // 3, size=2)
-            z = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            solution = (x * y) + z
-            problem_string = f"({x} x {y}) + {z} = "
-        elif problem_type == "compound_add_then_subtract":
-            x, y, z = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=3),
-                reverse=True,
-            )
-            solution = (x + y) - z
-            problem_string = f"({x} + {y}) - {z} = "
-        elif problem_type == "compound_subtract_then_add":
-            x, y, z = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=3),
-                reverse=True,
-            )
-            x = y + 1
-            solution = (x - y) + z
-            problem_string = f"({x} - {y}) + {z} = "
-        elif problem_type == "compound_subtract_then_multiply":
-            x, y = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=2),
-                reverse=True,
-            )
-            x = y + 1
-            z = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            solution = (x - y) * z
-            problem_string = f"({x} - {y}) x {z} = "
-        elif problem_type == "compound_multiply_then_subtract":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound // 3, size=2)
-            z = np.random.randint(low=0, high=x * y, size=1)[0]
-            solution = (x * y) - z
-            problem_string = f"({x} x {y}) - {z} = "
-        elif problem_type == "compound_add_then_add":
-            x, y, z = np.random.randint(low=lower_bound, high=upper_bound, size=3)
-            solution = (x + y) + z
-            problem_string = f"({x} + {y}) + {z} = "
-        elif problem_type == "compound_multiply_then_multiply":
-            x, y, z = np.random.randint(low=lower_bound, high=upper_bound // 3, size=3)
-            solution = (x * y) * z
-            problem_string = f"({x} x {y}) x {z} = "
-        elif problem_type == "compound_add_then_add_then_add":
-            x, y, z = np.random.randint(low=lower_bound, high=upper_bound, size=3)
-            w = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            solution = (x + y) + (z + w)
-            problem_string = f"({x} + {y}) + ({z} + {w}) = "
-        elif problem_type == "compound_multiply_then_multiply_then_multiply":
-            x, y, z = np.random.randint(low=lower_bound, high=upper_bound // 3, size=3)
-            w = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            solution = (x * y) * (z * w)
-            problem_string = f"({x} x {y}) x ({z} x {w}) = "
-        elif problem_type == "compound_add_then_subtract_then_multiply":
-            x, y, z = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=3),
-                reverse=True,
-            )
-            w = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            solution = ((x + y) - z) * w
-            problem_string = f"(({x} + {y}) - {z}) x {w} = "
-        elif problem_type == "compound_subtract_then_add_then_multiply":
-            x, y, z = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=3),
-                reverse=True,
-            )
-            w = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            solution = ((x - y) + z) * w
-            problem_string = f"(({x} - {y}) + {z}) x {w} = "
-        elif problem_type == "compound_add_then_add_then_subtract":
-            x, y, z, w = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=4),
-                reverse=True,
-            )
-            solution = (x + y) + (z - w)
-            problem_string = f"({x} + {y}) + ({z} - {w}) = "
-        elif problem_type == "compound_subtract_then_add_then_add":
-            x, y, z = np.random.randint(low=lower_bound, high=upper_bound, size=3)
-            x = y + 1
-            w = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            solution = (x - y) + (z + w)
-            problem_string = f"({x} - {y}) + ({z} + {w}) = "
-        elif problem_type == "compound_subtract_then_multiply_then_add":
-            x, y = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=2),
-                reverse=True,
-            )
-            x = y + 1
-            z = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            w = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            solution = ((x - y) * z) + w
-            problem_string = f"(({x} - {y}) x {z}) + {w} = "
-        elif problem_type == "compound_multiply_then_subtract_then_add":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound // 3, size=2)
-            z = np.random.randint(low=0, high=x * y, size=1)[0]
-            w = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            solution = ((x * y) - z) + w
-            problem_string = f"(({x} x {y}) - {z}) + {w} = "
-        elif problem_type == "compound_multiply_then_multiply_then_subtract":
-            x, y, z = np.random.randint(low=lower_bound, high=upper_bound // 3, size=3)
-            w = np.random.randint(low=0, high=(x * y) * z, size=1)[0]
-            solution = ((x * y) * z) - w
-            problem_string = f"(({x} x {y}) x {z}) - {w} = "
-        elif problem_type == "compound_multiply_then_subtract_then_multiply":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound // 3, size=2)
-            z = np.random.randint(low=0, high=x * y, size=1)[0]
-            w = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            solution = ((x * y) - z) * w
-            problem_string = f"(({x} x {y}) - {z}) x {w} = "
-        elif problem_type == "compound_subtract_then_multiply_then_multiply":
-            x, y = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=2),
-                reverse=True,
-            )
-            x = y + 1
-            z = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            w = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            solution = ((x - y) * z) * w
-            problem_string = f"(({x} - {y}) x {z}) x {w} = "
-        elif problem_type == "compound_subtract_then_multiply_then_subtract":
-            x, y = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=2),
-                reverse=True,
-            )
-            x = y + 1
-            z = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            w = np.random.randint(low=0, high=(x - y) * z, size=1)[0]
-            solution = ((x - y) * z) - w
-            problem_string = f"(({x} - {y}) x {z}) - {w} = "
-        elif problem_type == "compound_add_then_multiply_then_add":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound, size=2)
-            z = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            w = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            solution = ((x + y) * z) + w
-            problem_string = f"(({x} + {y}) x {z}) + {w} = "
-        elif problem_type == "compound_add_then_multiply_then_subtract":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound, size=2)
-            z = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            w = np.random.randint(low=0, high=(x + y) * z, size=1)[0]
-            solution = ((x + y) * z) - w
-            problem_string = f"(({x} + {y}) x {z}) - {w} = "
-        elif problem_type == "compound_add_then_subtract_then_multiply":
-            x, y, z = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=3),
-                reverse=True,
-            )
-            w = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            solution = ((x + y) - z) * w
-            problem_string = f"(({x} + {y}) - {z}) x {w} = "
-        elif problem_type == "compound_add_then_subtract_then_add":
-            x, y, z = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=3),
-                reverse=True,
-            )
-            w = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            solution = ((x + y) - z) + w
-            problem_string = f"(({x} + {y}) - {z}) + {w} = "
-        elif problem_type == "compound_multiply_then_add_then_multiply":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound // 3, size=2)
-            z = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            w = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            solution = ((x * y) + z) * w
-            problem_string = f"(({x} x {y}) + {z}) x {w} = "
-        elif problem_type == "compound_multiply_then_add_then_add":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound // 3, size=2)
-            z = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            w = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            solution = ((x * y) + z) + w
-            problem_string = f"(({x} x {y}) + {z}) + {w} = "
-        elif problem_type == "compound_multiply_then_subtract_then_multiply":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound // 3, size=2)
-            z = np.random.randint(low=0, high=x * y, size=1)[0]
-            w = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            solution = ((x * y) - z) * w
-            problem_string = f"(({x} x {y}) - {z}) x {w} = "
-        elif problem_type == "compound_multiply_then_subtract_then_add":
-            x, y = np.random.randint(low=lower_bound, high=upper_bound // 3, size=2)
-            z = np.random.randint(low=0, high=x * y, size=1)[0]
-            w = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            solution = ((x * y) - z) + w
-            problem_string = f"(({x} x {y}) - {z}) + {w} = "
-        elif problem_type == "compound_subtract_then_add_then_multiply":
-            x, y, z = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=3),
-                reverse=True,
-            )
-            x = y + 1
-            w = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            solution = ((x - y) + z) * w
-            problem_string = f"(({x} - {y}) + {z}) x {w} = "
-        elif problem_type == "compound_subtract_then_add_then_subtract":
-            x, y, z = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=3),
-                reverse=True,
-            )
-            x = y + 1
-            w = np.random.randint(low=0, high=(x - y) + z, size=1)[0]
-            solution = ((x - y) + z) - w
-            problem_string = f"(({x} - {y}) + {z}) - {w} = "
-        elif problem_type == "compound_subtract_then_multiply_then_add":
-            x, y = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=2),
-                reverse=True,
-            )
-            x = y + 1
-            z = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            w = np.random.randint(low=lower_bound, high=upper_bound, size=1)[0]
-            solution = ((x - y) * z) + w
-            problem_string = f"(({x} - {y}) x {z}) + {w} = "
-        elif problem_type == "compound_subtract_then_multiply_then_subtract":
-            x, y = sorted(
-                np.random.randint(low=lower_bound, high=upper_bound, size=2),
-                reverse=True,
-            )
-            x = y + 1
-            z = np.random.randint(low=lower_bound, high=upper_bound // 3, size=1)[0]
-            w = np.random.randint(low=0, high=(x - y) * z, size=1)[0]
-            solution = ((x - y) * z) - w
-            problem_string = f"(({x} - {y}) x {z}) - {w} = "
-        else:
-            raise ValueError(f"Invalid problem type: {problem_type}")
-
-        score = 1  # Base score for each problem
-        # We reward a higher score for compound problems, since they are more difficult. We increase score by one for each operation in the compound problem. So, a compound problem with 3 operations is worth 3 points, and a compound problem with 2 operations is worth 2 points.
-        if problem_type.count("then") == 2:
-            score = 3
-        elif problem_type.count("then") == 1:
-            score = 2
-
-        return problem_string, int(solution), score
+        return self.session.generate_problem()
 
     def check_answer(self, event=None):
         # Check user's answer, then update score and question
-        self.label_timer.config(
-            text=f"Time: {(self.end_time - datetime.now()).seconds}"
-        )
-        user_solution = self.entry_answer.get()
-        if user_solution == str(self.solution):
-            self.score += self.problem_score
-            self.label_score.config(text=f"Score: {self.score}")
+        self.show_next_problem(self.session.submit(self.entry_answer.get()))
+
+    def check_typed(self, *args):
+        # Runs on every keystroke with auto-advance, synchronously with the key event so a right answer moves on within the same frame
+        # A keystroke that does not complete the right answer costs a single string comparison, and no widget is touched
+        if self.session.check_typed(self.answer_text.get()):
+            self.show_next_problem(True)
+
+    def show_next_problem(self, correct):
+        if correct:
+            self.set_text(self.label_score, f"Score: {self.session.score}")
         self.update_problem()
         self.entry_answer.delete(0, tk.END)
+        self.schedule_refill()
+
+    def schedule_tick(self):
+        # Run check_timer when the displayed seconds next change, or at the end of the game. The delay is worked out from the session's deadline on the monotonic clock every time, so late callbacks never add up to drift
+        delay = self.session.next_tick()
+        self.game_root.after(max(1, math.ceil(delay * 1000)), self.check_timer)
 
     def check_timer(self):
-        # Check if time is up every second: if so, end game then show and save results, otherwise keep checking
-        if datetime.now() < self.end_time:
-            self.game_root.after(1000, self.check_timer)
+        # Check if time is up: if so, end game then show and save results, otherwise show the time left and wait for the next tick
+        if self.session.tick():
+            self.set_text(self.label_timer, f"Time: {self.session.seconds_left()}")
+            self.schedule_tick()
         else:
-            self.label_question.config(text="Game Over!")
+            self.set_text(self.label_question, "Game Over!")
             self.entry_answer.destroy()
-            self.label_timer.config(text="Time's up!")
-            self.label_score.config(text=f"Final score: {self.score}")
+            self.set_text(self.label_timer, "Time's up!")
+            self.set_text(self.label_score, f"Final score: {self.session.score}")
+            # Draw the final score right away, before saving the score (which loads pandas the first time) holds up the event loop
+            self.refresh()
+            self.game_root.update_idletasks()
+            self.session.answer_log.flush()
+            if self.session.scheduler is not None:
+                from scheduler import save_stats
+
+                save_stats(scores_folder, self.username, self.session.scheduler)
+            if self.session.review is not None:
+                from review import save_review
+
+                save_review(scores_folder, self.username, self.session.review)
 
             self.save_score()
+            if self.recorder is not None:
+                self.recorder.dump()
 
     def save_score(self):
         current_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        # Check if username exists already in scores folder to load previous scores, if not, create new file to track scores
-        score_file = f"{scores_folder}/{self.username}.csv"
-        try:
-            scores = pd.read_csv(score_file)
-        except FileNotFoundError:
-            scores = pd.DataFrame(columns=["Username", "DateTime", "Score"])
-
-        # Append new score data and save updated scores to CSV
-        new_score = {
-            "Username": self.username,
-            "DateTime": current_timestamp,
-            "Score": self.score,
-        }
-        scores = pd.concat(
-            [scores, pd.DataFrame(new_score, index=[0])], ignore_index=True
-        )
-        scores.to_csv(score_file, index=False)
+        # Append just the new score to the user's history (a new file is created for new usernames), see storage.py
+        self.score_store().append(self.username, current_timestamp, self.session.score)
+        # Rank the score among everybody else's games first, so the player is not ranked against their own game, then add it to the global score distribution
+        distribution = self.score_distribution()
+        self.ranks = [
+            (name,)
+            + distribution.rank(
+                self.time_limit, self.session.score, window, current_timestamp
+            )
+            for window, name in (("today", "today"), ("all", "of all time"))
+        ]
+        distribution.add(self.time_limit, current_timestamp, self.session.score)
+
+        self.display_scores()
 
-        self.display_scores(scores)
+    def score_store(self):
+        # Open the score store on first use, which is when storage.py and pandas get imported
+        if self.store is None:
+            from storage import open_score_store
 
-    def display_scores(self, scores):
+            self.store = open_score_store(
+                score_backend, os.path.join(scores_folder, self.game_folder)
+            )
+        return self.store
+
+    def score_distribution(self):
+        if self.distribution is None:
+            from percentiles import ScoreDistribution
+
+            self.distribution = ScoreDistribution(
+                os.path.join(percentiles_folder, self.game_folder)
+            )
+        return self.distribution
+
+    def display_scores(self):
         # For this user, display their 5 most recent scores, if available, and their top 5 scores of all time, if available in the UI
+        # Both come from the user's score summary, so the full history is never loaded here
+        # Above them, show how this score ranks among every other game with the same time limit, worked out by save_score from the score sketches
+        ranks = [
+            f"{rank:.0%} of {games:,} other games {name}"
+            for name, rank, games in self.ranks
+            if games
+        ]
+        if ranks:
+            self.label_rank = tk.Label(
+                self.game_root,
+                text="You beat " + " and ".join(ranks),
+                font=(self.font, self.font_size),
+            )
+            self.label_rank.pack(pady=5)
         self.label_recent_scores = tk.Label(
             self.game_root, text="Recent Scores:", font=(self.font, self.font_size)
         )
         self.label_recent_scores.pack(pady=5)
-        # Get most recent scores from user's Dataframe and display them as rows in blue in the UI
-        recent_scores = (
-            scores[scores["Username"] == self.username]
-            .sort_values(by="DateTime", ascending=False)
-            .head(5)
-        )
+        # Get most recent scores from the score store and display them as rows in blue in the UI
         recent_scores_str = "\n".join(
             [
-                f"{row['DateTime']}: {row['Score']}"
-                for _, row in recent_scores.iterrows()
+                f"{timestamp}: {score}"
+                for timestamp, score in self.store.recent(self.username)
             ]
         )
         self.label_recent_scores_values = tk.Label(
@@ -460,14 +320,12 @@ class UltraMac:
             self.game_root, text="Top Scores:", font=(self.font, self.font_size)
         )
         self.label_top_scores.pack(pady=5)
-        # Get highest scores from user's Dataframe and display them as rows in blue in the UI
-        top_scores = (
-            scores[scores["Username"] == self.username]
-            .sort_values(by="Score", ascending=False)
-            .head(5)
-        )
+        # Get highest scores from the score store and display them as rows in green in the UI
         top_scores_str = "\n".join(
-            [f"{row['DateTime']}: {row['Score']}" for _, row in top_scores.iterrows()]
+            [
+                f"{timestamp}: {score}"
+                for timestamp, score in self.store.top(self.username)
+            ]
         )
         self.label_top_scores_values = tk.Label(
             self.game_root,
@@ -478,7 +336,22 @@ class UltraMac:
         self.label_top_scores_values.pack(pady=5)
 
 
-def launch_game():
+def launch_game(
+    seed=None,
+    daily=False,
+    adaptive=False,
+    expression_depth=None,
+    no_repeats=False,
+    auto_advance=False,
+    review=False,
+    instrument=False,
+):
+    # Instrumentation is on with instrument=True, or with ULTRAMAC_INSTRUMENT set to anything but 0
+    recorder = None
+    if instrument or os.environ.get("ULTRAMAC_INSTRUMENT", "0") not in ("", "0"):
+        import instrument as instrumentation
+
+        recorder = instrumentation.enable(instrument_folder, UltraMac)
     root = tk.Tk()
     root.withdraw()  # This hides the root window, which is kind of ugly - we use simpledialog instead
     username = simpledialog.askstring(
@@ -487,26 +360,81 @@ def launch_game():
     if username:
         root.destroy()  # Destroy username window because no longer used
         game_root = tk.Tk()  # Create a new root for the main game window
-        app = UltraMac(username=username, game_root=game_root)
+        # The daily challenge is the same deck of problems for every player today
+        problems = None
+        if daily:
+            from decks import DeckSource, daily_seed, load_deck
+
+            problems = DeckSource(load_deck(decks_folder, daily_seed()))
+        app = UltraMac(
+            username=username,
+            game_root=game_root,
+            seed=seed,
+            problems=problems,
+            adaptive=adaptive,
+            expression_depth=expression_depth,
+            no_repeats=no_repeats,
+            auto_advance=auto_advance,
+            review=review,
+            recorder=recorder,
+        )
         app.game_root.mainloop()  # Keep running the game until user closes the main game window
+        if app.store is not None:
+            app.store.close()  # Let any background work on the score files finish before exiting
     else:
         print("You must provide a username. No username provided, so exiting.")
 
 
-# Use unittest to test generate_problem method, specifically making sure that the solution is always a non-negative integer
-class TestGenerateProblem(unittest.TestCase):
-    def setUp(self):
-        game_root = tk.Tk()  # Create a new root for the main game window
-        self.ultra_mac = UltraMac(username="tester", game_root=game_root)
-
-    def test_generate_problem(self):
-        for _ in range(10000):
-            _, solution, _ = self.ultra_mac.generate_problem()
-            self.assertGreaterEqual(solution, 0, "Solution is negative")
-            self.assertIsInstance(solution, int, "Solution is not an integer")
-
-
 if __name__ == "__main__":
-    # used just for testing generate_problem method
-    # unittest.main()
-    launch_game()
+    parser = argparse.ArgumentParser(description="UltraMac speed math game")
+    parser.add_argument("--seed", type=int, help="play a reproducible game")
+    parser.add_argument(
+        "--daily", action="store_true", help="play today's daily challenge deck"
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="serve more of the problem types that are at the right difficulty for you",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        help="play random expression problems with this many levels of operations",
+    )
+    parser.add_argument(
+        "--no-repeats",
+        action="store_true",
+        help="never show the same problem twice in a game",
+    )
+    parser.add_argument(
+        "--auto",
+        action="store_true",
+        help="move on as soon as the typed answer is right, without pressing Enter",
+    )
+    parser.add_argument(
+        "--review",
+        action="store_true",
+        help="bring back the problems you got wrong until you get them right",
+    )
+    parser.add_argument(
+        "--instrument",
+        action="store_true",
+        help=f"time the game's hot paths and dump the timings to {instrument_folder}",
+    )
+    args = parser.parse_args()
+    if args.seed is not None and args.seed < 0:
+        parser.error("--seed must not be negative")
+    if args.depth is not None and args.depth < 1:
+        parser.error("--depth must be at least 1")
+    if args.review and (args.daily or args.depth is not None):
+        parser.error("--review cannot be combined with --daily or --depth")
+    launch_game(
+        seed=args.seed,
+        daily=args.daily,
+        adaptive=args.adaptive,
+        expression_depth=args.depth,
+        no_repeats=args.no_repeats,
+        auto_advance=args.auto,
+        review=args.review,
+        instrument=args.instrument,
+    )
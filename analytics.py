@@ -0,0 +1,285 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+# Analytics over every score history in the scores folder, for questions across all users such as "who improved most this month" or "average score by hour of day".
+# Files are read by a pool of worker processes, a batch of files per task, in chunks of rows with compact dtypes. Each task returns partial aggregates (sums for a least-squares trend, a score histogram and the last few games per user, plus score sums by hour of day) which are merged as they come in.
+# Only partial aggregates travel between processes and only a bounded number of tasks are in flight at once, so memory does not grow with the size of the histories or the number of files.
+
+score_dtypes = {"Username": "category", "DateTime": "string", "Score": "Int32"}
+timestamp_format = "%Y-%m-%d %H:%M:%S"
+# Trend slopes are in score per day, measured from this date
+origin = pd.Timestamp("2020-01-01")
+
+
+def _new_totals():
+    # Score sums and game counts for each hour of the day
+    return np.zeros(24), np.zeros(24, dtype=np.int64)
+
+
+def _merge_user(users, username, partial, window):
+    # Add one user's partial aggregate to the running ones. A partial is [games, sum t, sum score, sum t*t, sum t*score, score histogram, last times, last scores]
+    if username not in users:
+        users[username] = partial
+        return
+    current = users[username]
+    for i in range(5):
+        current[i] += partial[i]
+    size = max(len(current[5]), len(partial[5]))
+    current[5] = np.pad(current[5], (0, size - len(current[5]))) + np.pad(
+        partial[5], (0, size - len(partial[5]))
+    )
+    times = np.concatenate([current[6], partial[6]])
+    scores = np.concatenate([current[7], partial[7]])
+    order = np.argsort(times, kind="stable")[-window:]
+    current[6], current[7] = times[order], scores[order]
+
+
+def scan_files(paths, since=None, window=10, chunksize=100000):
+    # Partial aggregates for a batch of score files, this is what each worker process runs
+    users = {}
+    hour_sums, hour_counts = _new_totals()
+    for path in paths:
+        try:
+            reader = pd.read_csv(
+                path, dtype=score_dtypes, chunksize=chunksize, on_bad_lines="skip"
+            )
+            for chunk in reader:
+                if list(chunk.columns) != list(score_dtypes):
+                    break  # Not a score history
+                times = pd.to_datetime(
+                    chunk["DateTime"], format=timestamp_format, errors="coerce"
+                )
+                keep = times.notna() & chunk["Score"].notna()
+                if since is not None:
+                    keep &= times >= since
+                times = times[keep]
+                scores = chunk["Score"][keep].astype(np.int32)
+                usernames = chunk["Username"][keep]
+                hours = times.dt.hour.to_numpy()
+                hour_sums += np.bincount(hours, weights=scores.to_numpy(), minlength=24)
+                hour_counts += np.bincount(hours, minlength=24)
+                t = ((times - origin) / pd.Timedelta(days=1)).to_numpy()
+                y = scores.to_numpy().astype(np.float64)
+                frame = pd.DataFrame(
+                    {
+                        "username": usernames.to_numpy(),
+                        "t": t,
+                        "y": y,
+                        "tt": t * t,
+                        "ty": t * y,
+                    }
+                )
+                for username, group in frame.groupby(
+                    "username", observed=True, sort=False
+                ):
+                    tail = np.argsort(group["t"].to_numpy(), kind="stable")[-window:]
+                    partial = [
+                        len(group),
+                        group["t"].sum(),
+                        group["y"].sum(),
+                        group["tt"].sum(),
+                        group["ty"].sum(),
+                        np.bincount(group["y"].to_numpy().astype(np.int64).clip(0)),
+                        group["t"].to_numpy()[tail],
+                        group["y"].to_numpy()[tail],
+                    ]
+                    _merge_user(users, username, partial, window)
+        except (FileNotFoundError, pd.errors.EmptyDataError):
+            continue
+    return users, hour_sums, hour_counts
+
+
+def _score_files(folder):
+    # Score history files in the folder, listed lazily since there can be hundreds of thousands
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.endswith(".csv") and entry.is_file():
+                yield entry.path
+
+
+def _batches(paths, size):
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def percentile_from_histogram(histogram, q):
+    # The q-th percentile (0-100) of the scores counted in a histogram of score -> count
+    cumulative = np.cumsum(histogram)
+    if cumulative[-1] == 0:
+        return np.nan
+    return int(np.searchsorted(cumulative, q / 100 * cumulative[-1]))
+
+
+def analyze_scores(
+    folder, processes=None, since=None, window=10, files_per_task=256, chunksize=100000
+):
+    # Scan every score history in folder and return (per-user statistics, average score by hour of day) as two DataFrames
+    # since limits the analysis to games from that time on (for example the start of this month), window is the number of most recent games in the rolling average
+    since = pd.Timestamp(since) if since is not None else None
+    users = {}
+    hour_sums, hour_counts = _new_totals()
+
+    def merge(result):
+        nonlocal hour_sums, hour_counts
+        partial_users, sums, counts = result
+        for username, partial in partial_users.items():
+            _merge_user(users, username, partial, window)
+        hour_sums += sums
+        hour_counts += counts
+
+    processes = processes or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        max_in_flight = 4 * processes
+        in_flight = set()
+        for batch in _batches(_score_files(folder), files_per_task):
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    merge(future.result())
+            in_flight.add(pool.submit(scan_files, batch, since, window, chunksize))
+        for future in in_flight:
+            merge(future.result())
+
+    rows = []
+    for username, (n, st, sy, stt, sty, histogram, _, last_scores) in users.items():
+        denominator = n * stt - st * st
+        trend = (
+            (n * sty - st * sy) / denominator
+            if n > 1 and denominator > 1e-12
+            else np.nan
+        )
+        rows.append(
+            {
+                "Username": username,
+                "Games": n,
+                "Mean": sy / n,
+                "TrendPerDay": trend,
+                "RollingMean": last_scores.mean(),
+                "P10": percentile_from_histogram(histogram, 10),
+                "P50": percentile_from_histogram(histogram, 50),
+                "P90": percentile_from_histogram(histogram, 90),
+            }
+        )
+    per_user = pd.DataFrame(
+        rows,
+        columns=[
+            "Username",
+            "Games",
+            "Mean",
+            "TrendPerDay",
+            "RollingMean",
+            "P10",
+            "P50",
+            "P90",
+        ],
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        by_hour = pd.DataFrame(
+            {
+                "Hour": np.arange(24),
+                "Games": hour_counts,
+                "MeanScore": hour_sums / hour_counts,
+            }
+        )
+    return (
+        per_user.sort_values(by="TrendPerDay", ascending=False, ignore_index=True),
+        by_hour,
+    )
+
+
+# Use unittest to test the merged aggregates against computing the same statistics directly with pandas
+class TestAnalyzeScores(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(32)
+        self.histories = []
+        for i in range(12):
+            games = int(rng.integers(2, 40))
+            times = pd.Timestamp("2024-03-01") + pd.to_timedelta(
+                np.sort(rng.integers(0, 60 * 24 * 30, size=games)), unit="min"
+            )
+            history = pd.DataFrame(
+                {
+                    "Username": f"user{i}",
+                    "DateTime": times.strftime(timestamp_format),
+                    "Score": rng.integers(0, 30, size=games)
+                    + i * np.arange(games) // 10,
+                }
+            )
+            history.to_csv(os.path.join(self.folder, f"user{i}.csv"), index=False)
+            self.histories.append(history)
+        with open(os.path.join(self.folder, "user0.summary.json"), "w") as f:
+            f.write("{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_matches_pandas(self):
+        per_user, by_hour = analyze_scores(
+            self.folder, processes=2, files_per_task=5, chunksize=7, window=5
+        )
+        per_user = per_user.set_index("Username")
+        self.assertEqual(len(per_user), 12)
+        everything = pd.concat(self.histories)
+        for history in self.histories:
+            row = per_user.loc[history["Username"][0]]
+            t = (pd.to_datetime(history["DateTime"]) - origin) / pd.Timedelta(days=1)
+            self.assertAlmostEqual(
+                row["TrendPerDay"], np.polyfit(t, history["Score"], 1)[0], places=6
+            )
+            self.assertAlmostEqual(row["RollingMean"], history["Score"].tail(5).mean())
+            self.assertEqual(row["Games"], len(history))
+            self.assertEqual(
+                row["P50"],
+                int(np.percentile(history["Score"], 50, method="inverted_cdf")),
+            )
+        hours = pd.to_datetime(everything["DateTime"]).dt.hour
+        expected = everything.groupby(hours.to_numpy())["Score"].mean()
+        for hour, mean in expected.items():
+            self.assertAlmostEqual(by_hour["MeanScore"][hour], mean)
+
+    def test_since(self):
+        per_user, _ = analyze_scores(self.folder, processes=1, since="2024-03-16")
+        for history in self.histories:
+            recent = history[history["DateTime"] >= "2024-03-16"]
+            games = per_user.set_index("Username")["Games"].get(
+                history["Username"][0], 0
+            )
+            self.assertEqual(games, len(recent))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyze every UltraMac score history")
+    parser.add_argument("folder", nargs="?", default="./data")
+    parser.add_argument(
+        "--processes", type=int, help="worker processes, all cores by default"
+    )
+    parser.add_argument(
+        "--since", help="only count games from this date on, such as 2024-04-01"
+    )
+    parser.add_argument(
+        "--window", type=int, default=10, help="games in the rolling average"
+    )
+    parser.add_argument("--out", help="save the per-user statistics to this CSV file")
+    args = parser.parse_args()
+    per_user, by_hour = analyze_scores(
+        args.folder, args.processes, args.since, args.window
+    )
+    if args.out:
+        per_user.to_csv(args.out, index=False)
+    print("Most improved players (score per day):")
+    print(per_user.head(10).to_string(index=False))
+    print("\nAverage score by hour of day:")
+    print(by_hour[by_hour["Games"] > 0].to_string(index=False))
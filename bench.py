@@ -0,0 +1,351 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from engine import GameSession
+from percentiles import KLLSketch, ScoreDistribution, save_sketches, sketch_key
+from problems import generate_batch, problem_templates
+from storage import open_score_store, score_columns
+from telemetry import AnswerLog
+
+# Benchmarks for UltraMac's hot paths: problem generation (problems/sec for every problem type), answer checking, and saving/displaying scores for histories of different sizes, and updating and reading the percentile sketches.
+# Each benchmark is run a few times after a warmup, and the time per operation of every run is kept. Results can be saved as JSON and compared with an earlier run to catch regressions:
+#   python bench.py --json before.json
+#   python bench.py --json after.json --compare before.json
+
+default_sizes = (10**2, 10**4, 10**6)
+# Most time allowed to import UltraMac.py (everything that runs before the username dialog appears), in seconds
+startup_budget = 0.2
+# Modules that must not be imported before the username dialog and the first problem, they are loaded once they are needed
+deferred_modules = ("numpy", "pandas", "unittest", "storage", "telemetry")
+# Most time allowed for handling one keystroke with auto-advance, in seconds, well under what a fast typist could notice
+keystroke_budget = 0.001
+
+
+def run_benchmark(name, func, loops, repeats=5, warmups=1):
+    # Time func() called loops times per run, and return the time per call of each run in seconds
+    for _ in range(warmups):
+        func()
+    values = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        values.append((time.perf_counter() - start) / loops)
+    return {
+        "name": name,
+        "loops": loops,
+        "values": values,
+        "mean": statistics.mean(values),
+        "min": min(values),
+        "stdev": statistics.stdev(values) if len(values) > 1 else 0.0,
+    }
+
+
+def bench_generation(batch_size=10000, repeats=5):
+    # Problems per second for each problem type, generated in batches
+    rng = np.random.default_rng(32)
+    results = []
+    for i, template in enumerate(problem_templates):
+        result = run_benchmark(
+            f"generate_batch[{template.name}]",
+            lambda: generate_batch(batch_size, rng, types=i),
+            loops=5,
+            repeats=repeats,
+        )
+        result["ops_per_sec"] = batch_size / result["mean"]
+        results.append(result)
+    result = run_benchmark(
+        "generate_batch[mixed]", lambda: generate_batch(batch_size, rng), 5, repeats
+    )
+    result["ops_per_sec"] = batch_size / result["mean"]
+    results.append(result)
+    return results
+
+
+def bench_check_answer(answers=10000, repeats=5):
+    # Submitting an answer and moving on to the next problem, as check_answer does without the Tk widgets
+    results = []
+    for name, correct, answer_log in [
+        ("check_answer[correct]", True, None),
+        ("check_answer[wrong]", False, None),
+        ("check_answer[telemetry]", True, AnswerLog(None, "bench")),
+    ]:
+        session = GameSession("bench", time_limit=10**9, seed=32, answer_log=answer_log)
+        # Answers are submitted at now=0.0, so the game starts then too and response times are real zeros, not negative
+        session.start(0.0)
+
+        def answer():
+            session.submit(str(session.solution) if correct else "", 0.0)
+            if session.problems.needs_refill():
+                session.problems.refill()  # What the Tk idle callbacks do between answers
+
+        result = run_benchmark(name, answer, answers, repeats)
+        result["ops_per_sec"] = 1 / result["mean"]
+        results.append(result)
+    return results
+
+
+def bench_keystrokes(keystrokes=10000, repeats=5):
+    # Auto-advance: the answer is typed one character at a time and checked after every keystroke, as UltraMac.check_typed does without the Tk widgets
+    session = GameSession("bench", time_limit=10**9, seed=32)
+    session.start(0.0)
+    typed = [""]
+
+    def keystroke():
+        solution = session.solution_string
+        typed[0] = solution[: len(typed[0]) + 1]
+        if session.check_typed(typed[0], 0.0):
+            typed[0] = ""
+            if session.problems.needs_refill():
+                session.problems.refill()
+
+    result = run_benchmark("check_typed[keystroke]", keystroke, keystrokes, repeats)
+    result["ops_per_sec"] = 1 / result["mean"]
+    return [result]
+
+
+def import_times(module="UltraMac"):
+    # Import module in a fresh interpreter with -X importtime, and return the cumulative import time of every module it imported, in seconds
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    ).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def bench_startup(repeats=5):
+    # Cold start of the game, measured as the time to import UltraMac.py in a fresh interpreter
+    values = [import_times()["UltraMac"] for _ in range(repeats)]
+    return [
+        {
+            "name": "startup[import UltraMac]",
+            "loops": 1,
+            "values": values,
+            "mean": statistics.mean(values),
+            "min": min(values),
+            "stdev": statistics.stdev(values) if len(values) > 1 else 0.0,
+        }
+    ]
+
+
+def write_history(store, folder, username, rows):
+    # Create a synthetic score history with rows games, one per minute
+    start = datetime(2020, 1, 1)
+    timestamps = [
+        (start + timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S")
+        for i in range(rows)
+    ]
+    scores = np.random.default_rng(rows).integers(0, 60, size=rows).tolist()
+    if hasattr(store, "score_file"):
+        history = pd.DataFrame(
+            {"Username": username, "DateTime": timestamps, "Score": scores},
+            columns=score_columns,
+        )
+        history.to_csv(store.score_file(username), index=False)
+    else:
+        for i in range(0, rows, 100000):
+            store.append_many(
+                [
+                    (username, t, s)
+                    for t, s in zip(timestamps[i : i + 100000], scores[i : i + 100000])
+                ]
+            )
+
+
+def bench_scores(sizes=default_sizes, backends=("csv", "sqlite"), repeats=5):
+    # save_score (append one game) and display_scores (recent and top five) against synthetic histories
+    results = []
+    for backend in backends:
+        for rows in sizes:
+            folder = tempfile.mkdtemp()
+            try:
+                store = open_score_store(backend, folder)
+                username = f"user{rows}"
+                write_history(store, folder, username, rows)
+                # The first display after a history is written builds the summary, time that on its own
+                start = time.perf_counter()
+                store.top(username)
+                results.append(
+                    {
+                        "name": f"first_display_scores[{backend},{rows}]",
+                        "loops": 1,
+                        "values": [time.perf_counter() - start],
+                    }
+                )
+                results[-1]["mean"] = results[-1]["min"] = results[-1]["values"][0]
+                results[-1]["stdev"] = 0.0
+                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                results.append(
+                    run_benchmark(
+                        f"save_score[{backend},{rows}]",
+                        lambda: store.append(username, now, 42),
+                        loops=20,
+                        repeats=repeats,
+                    )
+                )
+                results.append(
+                    run_benchmark(
+                        f"display_scores[{backend},{rows}]",
+                        lambda: (store.recent(username), store.top(username)),
+                        loops=20,
+                        repeats=repeats,
+                    )
+                )
+                store.close()
+            finally:
+                shutil.rmtree(folder)
+    return results
+
+
+def bench_percentiles(games=100000, repeats=5):
+    # Adding a game to the score sketches and ranking a score, after games games, which should cost the same whatever games is
+    folder = tempfile.mkdtemp()
+    try:
+        distribution = ScoreDistribution(folder, "bench")
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        rng = np.random.default_rng(32)
+        for window in ("today", "week", "all"):
+            sketch = KLLSketch()
+            for score in rng.integers(0, 200, size=games).tolist():
+                sketch.update(score)
+            distribution.sketches[sketch_key(120, window, now)] = sketch
+        save_sketches(distribution.node_file, distribution.sketches)
+        return [
+            run_benchmark(
+                f"percentile_add[{games}]",
+                lambda: distribution.add(120, now, 42),
+                loops=20,
+                repeats=repeats,
+            ),
+            run_benchmark(
+                f"percentile_rank[{games}]",
+                lambda: distribution.rank(120, 42, "all", now),
+                loops=1000,
+                repeats=repeats,
+            ),
+        ]
+    finally:
+        shutil.rmtree(folder)
+
+
+def run_all(sizes=default_sizes, repeats=5):
+    benchmarks = bench_startup(repeats)
+    benchmarks += bench_generation(repeats=repeats)
+    benchmarks += bench_check_answer(repeats=repeats)
+    benchmarks += bench_keystrokes(repeats=repeats)
+    benchmarks += bench_scores(sizes, repeats=repeats)
+    benchmarks += bench_percentiles(repeats=repeats)
+    return {
+        "metadata": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "benchmarks": {result["name"]: result for result in benchmarks},
+    }
+
+
+def compare(baseline, results, threshold=0.1):
+    # Compare the mean time of every benchmark in both runs. Returns rows of (name, baseline mean, new mean, ratio) and the names that got slower by more than threshold
+    rows = []
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        before = baseline["benchmarks"][name]["mean"]
+        ratio = result["mean"] / before
+        rows.append((name, before, result["mean"], ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def format_time(seconds):
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+# Use unittest to test the harness itself on tiny inputs
+class TestBench(unittest.TestCase):
+    def test_run_and_compare(self):
+        results = {"benchmarks": {}}
+        for result in bench_check_answer(answers=50, repeats=2) + bench_scores(
+            sizes=(10,), repeats=2
+        ):
+            results["benchmarks"][result["name"]] = result
+        self.assertIn("save_score[sqlite,10]", results["benchmarks"])
+        self.assertGreater(
+            results["benchmarks"]["check_answer[correct]"]["ops_per_sec"], 0
+        )
+        slower = json.loads(json.dumps(results))
+        slower["benchmarks"]["check_answer[wrong]"]["mean"] *= 2
+        rows, regressions = compare(results, slower)
+        self.assertEqual(len(rows), len(results["benchmarks"]))
+        self.assertEqual(regressions, ["check_answer[wrong]"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the UltraMac benchmarks")
+    parser.add_argument("--json", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in default_sizes),
+        help="comma-separated score history sizes",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="slowdown reported as a regression"
+    )
+    args = parser.parse_args()
+
+    results = run_all([int(size) for size in args.sizes.split(",")], args.repeats)
+    for name, result in results["benchmarks"].items():
+        rate = f"  ({result['ops_per_sec']:,.0f}/s)" if "ops_per_sec" in result else ""
+        print(
+            f"{name:60} {format_time(result['mean']):>10} +- {format_time(result['stdev'])}{rate}"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows, regressions = compare(baseline, results, args.threshold)
+        print()
+        for name, before, after, ratio in rows:
+            print(
+                f"{name:60} {format_time(before):>10} -> {format_time(after):>10}  x{ratio:.2f}"
+            )
+        if regressions:
+            print(
+                f"\n{len(regressions)} benchmark(s) slower by more than {args.threshold:.0%}:"
+            )
+            print("\n".join(regressions))
+            sys.exit(1)
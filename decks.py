@@ -0,0 +1,124 @@
+from datetime import date
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from files import atomic_write
+from problem_table import table_checksum
+from problems import (
+    Problem,
+    ProblemBatch,
+    format_problem,
+    generate_batch,
+    max_operands,
+)
+
+# Decks are fixed, reproducible lists of problems: a seed always expands into the same deck, so every player given that seed (for example today's daily challenge) gets the exact same problems in the same order.
+# A deck is generated once and cached as a .npy file of a compact numpy structured array, which is memory-mapped when loaded, so many game processes can share one generated file instead of each generating their own.
+# Problem types are stored as indexes into problem_templates, so the cache file name includes a checksum of the problem type names and a deck is regenerated if the table ever changes.
+
+deck_dtype = np.dtype(
+    [
+        ("type", np.uint8),
+        ("operands", np.int32, (max_operands,)),
+        ("solution", np.int32),
+        ("score", np.uint8),
+    ]
+)
+
+
+def build_deck(seed, size=1000):
+    # Expand a seed into a deck of size problems
+    batch = generate_batch(size, np.random.default_rng(seed))
+    deck = np.empty(size, dtype=deck_dtype)
+    deck["type"] = batch.types
+    deck["operands"] = batch.operands
+    deck["solution"] = batch.solutions
+    deck["score"] = batch.scores
+    return deck
+
+
+def deck_batch(deck):
+    # View a deck as a columnar ProblemBatch
+    return ProblemBatch(deck["type"], deck["operands"], deck["solution"], deck["score"])
+
+
+def deck_file(folder, seed, size):
+    return os.path.join(folder, f"deck-{seed}-{size}-{table_checksum:08x}.npy")
+
+
+def load_deck(folder, seed, size=1000):
+    # Memory-map the cached deck for this seed, generating and caching it first if needed
+    path = deck_file(folder, seed, size)
+    if not os.path.exists(path):
+        # Written atomically, so other processes never map a half-written deck
+        with atomic_write(path, "wb") as f:
+            np.save(f, build_deck(seed, size))
+    return np.load(path, mmap_mode="r")
+
+
+def daily_seed(day=None):
+    # Seed of the daily challenge deck, the same for everyone on a given day, such as 20240408
+    day = day if day is not None else date.today()
+    return int(day.strftime("%Y%m%d"))
+
+
+class DeckSource:
+    # Serves a deck's problems in order, starting over at the end. Works as the problems of a GameSession in place of a ProblemQueue
+    def __init__(self, deck):
+        self.deck = deck
+        self.position = 0
+
+    def __len__(self):
+        return len(self.deck) - self.position
+
+    def needs_refill(self):
+        return False
+
+    def refill(self):
+        return 0
+
+    def fill(self):
+        pass
+
+    def pop(self):
+        row = self.deck[self.position]
+        self.position = (self.position + 1) % len(self.deck)
+        problem_type = int(row["type"])
+        operands = row["operands"].tolist()
+        return Problem(
+            problem_type,
+            operands,
+            format_problem(problem_type, operands),
+            int(row["solution"]),
+            int(row["score"]),
+        )
+
+
+# Use unittest to test that decks are reproducible and that cached decks are shared
+class TestDecks(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_same_seed_same_deck(self):
+        np.testing.assert_array_equal(build_deck(7, 100), build_deck(7, 100))
+        self.assertFalse(np.array_equal(build_deck(7, 100), build_deck(8, 100)))
+
+    def test_load_deck_is_cached_and_memory_mapped(self):
+        deck = load_deck(self.folder, daily_seed(date(2024, 4, 8)), 50)
+        self.assertIsInstance(deck, np.memmap)
+        self.assertEqual(os.listdir(self.folder), [os.path.basename(deck.filename)])
+        np.testing.assert_array_equal(deck, build_deck(20240408, 50))
+        batch = deck_batch(deck)
+        self.assertTrue((batch.solutions >= 0).all())
+
+    def test_players_get_the_same_problems(self):
+        deck = load_deck(self.folder, 1, 20)
+        first, second = DeckSource(deck), DeckSource(deck)
+        problems = [first.pop() for _ in range(25)]
+        self.assertEqual(problems, [second.pop() for _ in range(25)])
+        self.assertEqual(problems[20], problems[0])
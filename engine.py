@@ -0,0 +1,266 @@
+from collections import namedtuple
+from functools import partial
+import math
+import os
+import random
+import time
+from problem_table import draw_problem
+
+# Headless game engine for UltraMac: the rules and state of one timed game, with no Tkinter in sight so that games can be simulated or replayed without a display.
+# Problems come from a ProblemQueue that is filled ahead of time, so answering and moving on to the next problem never waits for problem generation.
+# Every session has a seed for its own numpy Generator (a random one is picked and kept in session.seed when none is given), so any game can be reproduced exactly from its seed.
+# Importing this module does not import numpy: the first problem of a game is drawn in plain Python (see problem_table.draw_problem), and numpy with the ProblemQueue only comes in on the first refill, which UltraMac does once the first problem is on screen. That is why the numpy-backed modules are imported where they are needed below.
+# The clock is injectable (any function returning seconds, time.monotonic by default) and every method that depends on time also accepts an explicit now, so a simulation can drive the game with made-up timestamps instead of waiting for real seconds to pass.
+
+GameResult = namedtuple(
+    "GameResult", ["username", "score", "answered", "correct", "time_limit"]
+)
+
+
+class GameSession:
+    # Time limit is in seconds, set to 20 for faster testing, normally set to 120 for players
+    def __init__(
+        self,
+        username,
+        time_limit=20,
+        clock=time.monotonic,
+        rng=None,
+        problems=None,
+        seed=None,
+        answer_log=None,
+        scheduler=None,
+        expression_depth=None,
+        index=None,
+        queue_size=None,
+        review=None,
+    ):
+        self.username = username
+        self.time_limit = time_limit
+        self.clock = clock
+        if seed is not None and seed < 0:
+            # numpy only takes non-negative seeds, and it is first seeded on a refill after the game has started
+            raise ValueError(f"Seed must not be negative, not {seed}")
+        if rng is None and seed is None:
+            # 128 random bits, like np.random.SeedSequence().entropy
+            seed = int.from_bytes(os.urandom(16), "little")
+        self.seed = seed
+        self._rng = rng
+        # Optional telemetry.AnswerLog that records every answer and how long it took
+        self.answer_log = answer_log
+        # Optional scheduler.TypeStats that learns from every answer and picks the problem types. The queue is kept short so the choice of types follows the player within the game
+        self.scheduler = scheduler
+        if review is not None and (
+            problems is not None or expression_depth is not None
+        ):
+            # A fixed deck such as the daily challenge has to be the same for every player, and expression problems are scored differently, so reviews only mix into the problem templates
+            raise ValueError(
+                "Review only works with the problem templates, not with a fixed deck or expression problems"
+            )
+        # With expression_depth, problems are random expression trees of that depth instead of the problem templates, see expressions.py
+        # With a problem_index.ProblemIndex, problems are drawn from it so that no problem repeats within the game
+        generate = None
+        if expression_depth is not None:
+            if expression_depth < 1:
+                raise ValueError(
+                    f"Expression depth must be at least 1, not {expression_depth}"
+                )
+            from expressions import generate_expressions
+
+            generate = partial(generate_expressions, depth=expression_depth)
+        elif index is not None:
+            generate = index.sampler(scheduler)
+        if problems is None and (scheduler is not None or generate is not None):
+            from problems import ProblemQueue
+
+            problems = ProblemQueue(
+                self.rng,
+                capacity=16,
+                chunk_size=8,
+                scheduler=scheduler,
+                generate=generate,
+            )
+        # How many problems the default ProblemQueue holds, a server hosting thousands of sessions keeps this short
+        self.queue_size = queue_size
+        if problems is None and self.seed is None:
+            # An injected rng has no seed to draw the first problem with in plain Python, so every problem comes from the rng
+            problems = self.make_queue()
+        if problems is None:
+            problems = StarterQueue(
+                draw_problem(random.Random(self.seed)), self.make_queue
+            )
+        # Optional review.ReviewQueue that remembers missed problems and serves some of them again once they are due
+        self.review = review
+        if review is not None:
+            # Without a seed, which reviews are served is seeded from the injected rng, so the game still replays
+            review_seed = self.seed
+            if review_seed is None:
+                review_seed = int(self.rng.integers(2**63))
+            problems = review.source(problems, random.Random(review_seed))
+        self.problems = problems
+        self.score = 0
+        self.answered = 0
+        self.correct = 0
+        self.end_time = None
+        self.finished = False
+        self.problem = None
+        self.shown_at = None
+        self.problem_string = None
+        self.solution = None
+        self.solution_string = None
+        self.problem_score = 0
+
+    @property
+    def rng(self):
+        # The session's numpy Generator, only created once something needs it
+        if self._rng is None:
+            import numpy as np
+
+            self._rng = np.random.default_rng(self.seed)
+        return self._rng
+
+    def make_queue(self):
+        from problems import ProblemQueue
+
+        if self.queue_size is None:
+            return ProblemQueue(self.rng)
+        return ProblemQueue(
+            self.rng, capacity=self.queue_size, chunk_size=self.queue_size
+        )
+
+    def start(self, now=None):
+        # Start the timer and load the first problem
+        now = self.clock() if now is None else now
+        self.end_time = now + self.time_limit
+        if self.answer_log is not None:
+            self.answer_log.start = now
+        self.next_problem(now)
+
+    def next_problem(self, now):
+        self.problem = self.problems.pop()
+        self.shown_at = now
+        self.problem_string = self.problem.string
+        self.solution = self.problem.solution
+        # Answers are compared as text, so the solution is converted once per problem instead of once per answer or keystroke
+        self.solution_string = str(self.solution)
+        self.problem_score = self.problem.score
+
+    def generate_problem(self):
+        # Generate a random quick math problem, see problem_table.py for how the problem types, bounds and scores are defined
+        from problems import generate_problem
+
+        return generate_problem(self.rng)
+
+    def submit(self, answer, now=None):
+        # Check the player's answer to the current problem, then move on to the next problem. Returns whether the answer was correct
+        now = self.clock() if now is None else now
+        if self.finished or not self.tick(now):
+            return False
+        correct = answer == self.solution_string
+        self.answered += 1
+        if correct:
+            self.correct += 1
+            self.score += self.problem_score
+        if self.answer_log is not None:
+            self.answer_log.record(now, self.problem, correct, now - self.shown_at)
+        if self.scheduler is not None and self.problem.type is not None:
+            self.scheduler.update(self.problem.type, correct, now - self.shown_at)
+        if self.review is not None and self.problem.type is not None:
+            self.review.update(self.problem, correct)
+        self.next_problem(now)
+        return correct
+
+    def check_typed(self, text, now=None):
+        # Auto-advance: called with the answer typed so far on every keystroke, submits it as soon as it equals the solution. Returns whether it did
+        if text != self.solution_string:
+            return False
+        return self.submit(text, now)
+
+    def time_left(self, now=None):
+        # Seconds left in the game, never negative. Before start the whole time limit is left
+        if self.end_time is None:
+            return float(self.time_limit)
+        now = self.clock() if now is None else now
+        return max(0.0, self.end_time - now)
+
+    def seconds_left(self, now=None):
+        # Whole seconds left as shown on a countdown: the time limit right at the start, 1 during the last second
+        return math.ceil(self.time_left(now))
+
+    def next_tick(self, now=None):
+        # Seconds until seconds_left changes, the last tick falls exactly on end_time
+        time_left = self.time_left(now)
+        return time_left - (math.ceil(time_left) - 1)
+
+    def tick(self, now=None):
+        # Check if time is up: if so, end the game. Returns True while the game is still running, which it is not before start
+        if self.end_time is None:
+            return False
+        if not self.finished and self.time_left(now) <= 0:
+            self.finished = True
+        return not self.finished
+
+    def result(self):
+        return GameResult(
+            self.username, self.score, self.answered, self.correct, self.time_limit
+        )
+
+
+class StarterQueue:
+    # Serves the first problem of a game, already drawn in plain Python, and only creates the real queue (with make_queue) when it is first refilled or the first problem has been used. Works as the problems of a GameSession in place of a ProblemQueue
+    def __init__(self, first, make_queue):
+        self.first = first
+        self.make_queue = make_queue
+        self.queue = None
+
+    def __len__(self):
+        return (self.first is not None) + (len(self.queue) if self.queue else 0)
+
+    def _queue(self):
+        if self.queue is None:
+            self.queue = self.make_queue()
+        return self.queue
+
+    def needs_refill(self):
+        return self.queue is None or self.queue.needs_refill()
+
+    def refill(self):
+        return self._queue().refill()
+
+    def fill(self):
+        self._queue().fill()
+
+    def fill_in_background(self):
+        self._queue().fill_in_background()
+
+    def pop(self):
+        if self.first is not None:
+            problem, self.first = self.first, None
+            return problem
+        return self._queue().pop()
+
+
+def simulate_session(
+    seed, accuracy=0.8, seconds_per_answer=1.5, time_limit=120, username="simulated"
+):
+    # Play one whole game without a display or real waiting: a simulated player answers every seconds_per_answer seconds and is right with probability accuracy
+    session = GameSession(username, time_limit=time_limit, clock=None, seed=seed)
+    rng = session.rng
+    now = 0.0
+    session.start(now)
+    while True:
+        now += seconds_per_answer
+        if not session.tick(now):
+            break
+        if rng.random() < accuracy:
+            session.submit(str(session.solution), now)
+        else:
+            session.submit("", now)
+    return session.result()
+
+
+def simulate_sessions(seeds, processes=None, **kwargs):
+    # Simulate one game per seed across a process pool, keyword arguments are passed through to simulate_session
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(partial(simulate_session, **kwargs), seeds, chunksize=64))
@@ -0,0 +1,197 @@
+from collections import namedtuple
+import unittest
+import numpy as np
+from problems import (
+    ADD,
+    DIV,
+    MUL,
+    POW,
+    SUB,
+    Problem,
+    exponent_high,
+    exponent_low,
+    max_operands,
+    operator_symbols,
+    upper_bound,
+)
+
+# Expression-tree problems of any depth over +, -, x, / and ^, as an alternative to the fixed problem templates in problems.py.
+# Trees are built top-down and backwards: we first pick the result, then pick an operator and the values its two children must evaluate to, and so on down to the leaves. Because every split is chosen to be exact (children of a division are built as target x divisor and divisor, subtraction as (target + b) - b, and so on), every tree is integral and non-negative by construction, with no retries, so the cost of a tree only grows with its number of nodes.
+# That number only grows linearly with depth: the left child of every operator goes one level deeper, and the right child is a leaf or, now and then, a single operation on two leaves. So a tree of depth d has at most 2d + 1 operators, and its length, generation time and score grow linearly too.
+# To keep the numbers doable in one's head, every subtree of depth k evaluates to at most max_value(k): leaves are below upper_bound, and each level can add at most one more leaf's worth, which is exactly what adding a leaf to the left child can reach. Multipliers and divisors are between 2 and 11, and powers only appear right above the leaves, with the same bases and exponents as the exponentiation problems.
+# The score of a tree is its number of operators, the same rule as for the template problems.
+
+leaf_max = upper_bound - 1
+factor_low, factor_high = 2, upper_bound // 3 - 1
+# Every small power, mapped to its base and exponent
+powers = {
+    base**exponent: (base, exponent)
+    for base in range(2, 10)
+    for exponent in range(exponent_low[base], exponent_high[base])
+}
+
+# A leaf has op None and its value, an operator node has its two children
+Node = namedtuple("Node", ["op", "left", "right", "value"])
+
+
+def max_value(depth):
+    return leaf_max * (depth + 1)
+
+
+def build_tree(
+    rng, depth, target, operators=(ADD, SUB, MUL, DIV, POW), branch_probability=0.3
+):
+    # Build a tree of the given depth that evaluates to target (0 <= target <= max_value(depth))
+    if depth == 0:
+        return Node(None, None, None, target)
+    # The left child always goes one level deeper, the right child is a leaf unless it randomly branches into one operation
+    left_cap = max_value(depth - 1)
+    right_depth = 0
+    if rng.random() < branch_probability:
+        right_depth = min(1, depth - 1)
+    right_cap = max_value(right_depth)
+
+    # Every operator that can produce target exactly with children inside their caps, with how to split target between the children
+    choices = []
+    if ADD in operators and target <= left_cap + right_cap:
+        choices.append(ADD)
+    if SUB in operators and target < left_cap:
+        choices.append(SUB)
+    if MUL in operators:
+        factors = [
+            d
+            for d in range(factor_low, factor_high + 1)
+            if target % d == 0 and target // d <= left_cap
+        ]
+        if factors:
+            choices.append(MUL)
+    if DIV in operators and factor_low * target <= left_cap:
+        choices.append(DIV)
+    if POW in operators and depth == 1 and target in powers:
+        choices.append(POW)
+    if not choices:
+        raise ValueError(
+            f"None of the operators can make {target} at depth {depth}, include ADD"
+        )
+    op = choices[rng.integers(len(choices))]
+
+    if op == ADD:
+        # Prefer splits where both sides are at least 1
+        low, high = max(0, target - right_cap), min(target, left_cap)
+        if high - low >= 2:
+            low, high = max(low, 1), min(high, target - 1)
+        left = int(rng.integers(low, high + 1))
+        right = target - left
+    elif op == SUB:
+        right = int(rng.integers(1, min(right_cap, left_cap - target) + 1))
+        left = target + right
+    elif op == MUL:
+        right = factors[rng.integers(len(factors))]
+        left = target // right
+    elif op == DIV:
+        right = int(
+            rng.integers(factor_low, min(factor_high, left_cap // max(target, 1)) + 1)
+        )
+        left = target * right
+    else:
+        left, right = powers[target]
+        return Node(
+            POW, Node(None, None, None, left), Node(None, None, None, right), target
+        )
+    return Node(
+        op,
+        build_tree(rng, depth - 1, left, operators, branch_probability),
+        build_tree(rng, right_depth, right, operators, branch_probability),
+        target,
+    )
+
+
+def format_tree(node, top=True):
+    # Problem string for a tree, with every operator below the top in parentheses
+    if node.op is None:
+        return str(node.value)
+    expression = f"{format_tree(node.left, False)} {operator_symbols[node.op]} {format_tree(node.right, False)}"
+    return f"{expression} = " if top else f"({expression})"
+
+
+def evaluate_tree(node):
+    if node.op is None:
+        return node.value
+    left, right = evaluate_tree(node.left), evaluate_tree(node.right)
+    if node.op == ADD:
+        return left + right
+    if node.op == SUB:
+        return left - right
+    if node.op == MUL:
+        return left * right
+    if node.op == DIV:
+        assert left % right == 0, "Division is not exact"
+        return left // right
+    return left**right
+
+
+def tree_leaves(node):
+    if node.op is None:
+        return [node.value]
+    return tree_leaves(node.left) + tree_leaves(node.right)
+
+
+def tree_score(node):
+    # One point per operator
+    if node.op is None:
+        return 0
+    return 1 + tree_score(node.left) + tree_score(node.right)
+
+
+def expression_problem(rng, depth=2, operators=(ADD, SUB, MUL, DIV, POW)):
+    if depth < 1:
+        raise ValueError(f"Expression depth must be at least 1, not {depth}")
+    # A random expression problem of the given depth. Its type is None since it is not one of problem_templates, and operands holds its first leaves
+    tree = build_tree(rng, depth, int(rng.integers(1, max_value(depth) + 1)), operators)
+    operands = (tree_leaves(tree) + [0] * max_operands)[:max_operands]
+    return Problem(None, operands, format_tree(tree), tree.value, tree_score(tree))
+
+
+def generate_expressions(n, rng, depth=2):
+    # n expression problems, in the form ProblemQueue expects from its generate function
+    return [expression_problem(rng, depth) for _ in range(n)]
+
+
+# Use unittest to test that trees of every depth are integral, non-negative and evaluate to what they claim
+class TestExpressionTrees(unittest.TestCase):
+    def test_trees_are_exact(self):
+        rng = np.random.default_rng(32)
+        for depth in range(1, 7):
+            for _ in range(2000):
+                target = int(rng.integers(0, max_value(depth) + 1))
+                tree = build_tree(rng, depth, target, branch_probability=0.5)
+                self.assertEqual(evaluate_tree(tree), target)
+                self.assertTrue(
+                    all(0 <= leaf <= leaf_max for leaf in tree_leaves(tree))
+                )
+        # The problem string evaluates to the solution too
+        for _ in range(500):
+            problem = expression_problem(rng, depth=3)
+            expression = (
+                problem.string.rstrip("= ").replace("x", "*").replace("^", "**")
+            )
+            self.assertEqual(eval(expression.replace("/", "//")), problem.solution)
+            self.assertGreaterEqual(problem.solution, 0)
+
+    def test_size_grows_linearly_with_depth(self):
+        rng = np.random.default_rng(32)
+        for depth in (1, 4, 10, 40, 200):
+            for _ in range(20):
+                problem = expression_problem(rng, depth)
+                self.assertLessEqual(problem.score, 2 * depth + 1)
+                self.assertGreaterEqual(problem.score, depth)
+        with self.assertRaises(ValueError):
+            expression_problem(rng, depth=0)
+
+    def test_operators_and_score(self):
+        rng = np.random.default_rng(32)
+        tree = build_tree(rng, 3, 50, operators=(ADD,), branch_probability=0.0)
+        self.assertEqual(tree_score(tree), 3)
+        self.assertEqual(len(tree_leaves(tree)), 4)
+        self.assertNotIn("-", format_tree(tree))
+        self.assertEqual(build_tree(rng, 1, 81, operators=(POW,)).op, POW)
@@ -0,0 +1,91 @@
+from contextlib import contextmanager
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+# Every data file that UltraMac replaces as a whole is written with atomic_write: decks, the problem index, telemetry chunks, scheduler statistics, review queues, instrumentation dumps, score sketches, score summaries and compacted score histories.
+# The data goes to a temporary file in the same folder, which is then renamed over the real file, so readers (in this or any other process) only ever see the old file or the whole new one, and a crash never leaves a half-written file behind.
+
+# Permissions for the files written, the same as open() would give a new file. The umask can only be read by setting it, so this is done once on import
+umask = os.umask(0o022)
+os.umask(umask)
+file_mode = 0o666 & ~umask
+
+
+@contextmanager
+def atomic_write(path, mode="w", fsync=False, **kwargs):
+    # Open a new temporary file next to path (creating the folder if needed) and rename it to path when the block ends. If the block raises, path is left as it was
+    # Every call gets its own temporary file, so concurrent writers never write into each other's files and the last one to finish wins
+    # With fsync=True the data is on disk before the rename, for files that cannot be rebuilt. Other keyword arguments go to open, such as newline for CSV files
+    folder = os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        # mkstemp makes files only the owner can read
+        os.chmod(temp_file, file_mode)
+        os.replace(temp_file, path)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+
+# Use unittest to test that a file is only ever replaced as a whole, and gets the same permissions as a file written with open
+class TestAtomicWrite(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "nested", "file.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_replace(self):
+        with atomic_write(self.path) as f:
+            f.write("first")
+        with atomic_write(self.path) as f:
+            f.write("second")
+            self.assertEqual(self.read(), "first")
+        self.assertEqual(self.read(), "second")
+        with open(os.path.join(self.folder, "plain.txt"), "w"):
+            pass
+        self.assertEqual(
+            stat.S_IMODE(os.stat(self.path).st_mode),
+            stat.S_IMODE(os.stat(os.path.join(self.folder, "plain.txt")).st_mode),
+        )
+
+    def test_failed_write_leaves_the_file(self):
+        with atomic_write(self.path) as f:
+            f.write("kept")
+        with self.assertRaises(RuntimeError):
+            with atomic_write(self.path) as f:
+                f.write("lost")
+                raise RuntimeError
+        self.assertEqual(self.read(), "kept")
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["file.txt"])
+
+    def test_concurrent_writers(self):
+        # Every file written is one writer's whole text, never a mix of two
+        texts = [str(i) * 100000 for i in range(8)]
+
+        def write(text):
+            for _ in range(20):
+                with atomic_write(self.path) as f:
+                    f.write(text)
+
+        threads = [threading.Thread(target=write, args=(text,)) for text in texts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIn(self.read(), texts)
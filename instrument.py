@@ -0,0 +1,192 @@
+from bisect import bisect_left
+import functools
+import json
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+from engine import GameSession
+from files import atomic_write
+from problem_table import problem_type_names
+
+# Opt-in instrumentation for finding where time goes in a running game, such as a slow save_score for a user with a huge history, without attaching a profiler.
+# enable wraps the game's hot paths in timers that add every call's latency to a fixed-bucket histogram, and wraps GameSession.submit to count answers per problem type. UltraMac.py only imports this module and calls enable when instrumentation is turned on, with --instrument or the ULTRAMAC_INSTRUMENT environment variable, so when it is off it costs nothing at all, not even an if per call.
+# The histograms and counters are dumped as JSON at the end of every game and whenever the process gets SIGUSR1, to one file per process that is replaced on every dump.
+
+# The stages of UltraMac that are timed
+game_stages = (
+    "generate_problem",
+    "refill_problems",
+    "check_answer",
+    "check_typed",
+    "update_problem",
+    "save_score",
+    "display_scores",
+)
+# Bucket upper bounds in seconds, doubling from 1 microsecond to about 16 seconds. Slower calls go in one more overflow bucket
+bucket_bounds = [1e-6 * 2**i for i in range(25)]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(bucket_bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        # Upper bound of the bucket holding the q-th percentile (0-100), the slowest call for the overflow bucket
+        target = q / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return bucket_bounds[i] if i < len(bucket_bounds) else self.max
+        return 0.0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "p50_s": self.percentile(50),
+            "p99_s": self.percentile(99),
+            "max_s": self.max,
+            "counts": self.counts,
+        }
+
+
+class Recorder:
+    def __init__(self, folder):
+        self.path = os.path.join(folder, f"{time.time_ns()}-{os.getpid()}.json")
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        if stage not in self.histograms:
+            self.histograms[stage] = Histogram()
+        self.histograms[stage].add(seconds)
+
+    def count(self, counter, key):
+        counts = self.counters.setdefault(counter, {})
+        counts[key] = counts.get(key, 0) + 1
+
+    def to_dict(self):
+        return {
+            "pid": os.getpid(),
+            "bucket_bounds_s": bucket_bounds,
+            "stages": {
+                stage: histogram.to_dict()
+                for stage, histogram in self.histograms.items()
+            },
+            "counters": self.counters,
+        }
+
+    def dump(self):
+        # Written atomically, so readers never see a half-written dump
+        with atomic_write(self.path) as f:
+            json.dump(self.to_dict(), f, indent=1)
+        return self.path
+
+
+def timed(recorder, stage, function):
+    # Wrap function so that every call's latency goes into the stage's histogram
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            recorder.observe(stage, time.perf_counter() - start)
+
+    return wrapper
+
+
+def counted(recorder, submit):
+    # Wrap GameSession.submit to count answers, and right answers, per problem type
+    @functools.wraps(submit)
+    def wrapper(session, answer, now=None):
+        problem = session.problem
+        correct = submit(session, answer, now)
+        if problem is not None and not session.finished:
+            name = (
+                "expression"
+                if problem.type is None
+                else problem_type_names[problem.type]
+            )
+            recorder.count("answers", name)
+            if correct:
+                recorder.count("correct", name)
+        return correct
+
+    return wrapper
+
+
+def enable(folder, app_class, session_class=GameSession, stages=game_stages):
+    # Wrap the stages of app_class (the UltraMac class) and the session's submit, and dump on SIGUSR1. Returns the Recorder
+    recorder = Recorder(folder)
+    for stage in stages:
+        setattr(app_class, stage, timed(recorder, stage, getattr(app_class, stage)))
+    session_class.submit = counted(recorder, session_class.submit)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signal_number, frame: recorder.dump())
+    return recorder
+
+
+# Use unittest to test the histograms and that enabled stages are timed, counted and dumped
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for seconds in [0.5e-6, 3e-6, 3e-6, 0.01, 100]:
+            histogram.add(seconds)
+        self.assertEqual(histogram.counts[0], 1)
+        self.assertEqual(histogram.counts[2], 2)  # Between 2 and 4 microseconds
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(histogram.percentile(50), 4e-6)
+        self.assertEqual(histogram.percentile(100), 100)
+
+    def test_enable_and_dump(self):
+        class App:
+            def __init__(self):
+                self.session = Session("tester", clock=None, seed=3)
+
+            def check_answer(self, answer, now):
+                return self.session.submit(answer, now)
+
+            def save_score(self):
+                time.sleep(0.01)
+
+        class Session(GameSession):
+            pass
+
+        original = GameSession.submit
+        recorder = enable(self.folder, App, Session, ("check_answer", "save_score"))
+        self.assertIs(GameSession.submit, original)
+        app = App()
+        app.session.start(0.0)
+        app.check_answer(app.session.solution_string, 1.0)
+        app.check_answer("", 2.0)
+        app.save_score()
+        with open(recorder.dump()) as f:
+            dump = json.load(f)
+        self.assertEqual(dump["stages"]["check_answer"]["count"], 2)
+        self.assertGreaterEqual(dump["stages"]["save_score"]["max_s"], 0.01)
+        self.assertEqual(sum(dump["counters"]["answers"].values()), 2)
+        self.assertEqual(sum(dump["counters"]["correct"].values()), 1)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
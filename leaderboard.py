@@ -0,0 +1,156 @@
+from collections import deque
+from datetime import datetime, timedelta
+import heapq
+import unittest
+import pandas as pd
+
+# Per-user score summary for the end-of-game screen, kept up to date one game at a time so the screen never has to load and sort a user's whole history.
+# The most recent scores are kept in a bounded ring buffer (a deque with maxlen) and the top k scores of each time window in a min-heap of size k, so adding a game costs O(log k) no matter how long the history is.
+# Top scores are kept for "today", "week" (ISO week) and "all" time. A window's heap is reset as soon as a score from a newer day or week arrives.
+
+timestamp_format = "%Y-%m-%d %H:%M:%S"
+windows = ("today", "week", "all")
+
+
+def window_key(window, timestamp):
+    # Key naming the day or week a timestamp falls in, keys of later windows sort after keys of earlier ones
+    if window == "all":
+        return "all"
+    moment = datetime.strptime(timestamp, timestamp_format)
+    if window == "today":
+        return moment.strftime("%Y-%m-%d")
+    if window == "week":
+        return moment.strftime("%G-W%V")
+    raise ValueError(f"Invalid window: {window}")
+
+
+def window_start(window, now=None):
+    # Earliest timestamp inside the window, as a string that compares correctly with stored timestamps
+    now = now if now is not None else datetime.now()
+    if window == "all":
+        return ""
+    if window == "today":
+        return now.strftime("%Y-%m-%d 00:00:00")
+    if window == "week":
+        return (now - timedelta(days=now.weekday())).strftime("%Y-%m-%d 00:00:00")
+    raise ValueError(f"Invalid window: {window}")
+
+
+class ScoreSummary:
+    def __init__(self, k=5, recent_count=5):
+        self.k = k
+        self.recent = deque(maxlen=recent_count)
+        # Each window holds [window key, min-heap of (score, timestamp)]
+        self.tops = {window: [None, []] for window in windows}
+
+    def add(self, timestamp, score):
+        self.recent.append((timestamp, score))
+        for window in windows:
+            key = window_key(window, timestamp)
+            top = self.tops[window]
+            if top[0] is None or key > top[0]:
+                top[0], top[1] = key, []
+            elif key < top[0]:
+                continue  # Score belongs to a window that has already passed
+            if len(top[1]) < self.k:
+                heapq.heappush(top[1], (score, timestamp))
+            else:
+                heapq.heappushpop(top[1], (score, timestamp))
+
+    def recent_scores(self, n=None):
+        # Most recent scores first, as (timestamp, score) pairs
+        return list(reversed(self.recent))[:n]
+
+    def top_scores(self, window="all", n=None, now=None):
+        # Highest scores first, as (timestamp, score) pairs. Windows that have passed (yesterday, last week) are empty
+        key, heap = self.tops[window]
+        now = now if now is not None else datetime.now().strftime(timestamp_format)
+        if key is None or key != window_key(window, now):
+            return []
+        return [(timestamp, score) for score, timestamp in sorted(heap, reverse=True)][
+            :n
+        ]
+
+    def to_dict(self):
+        return {
+            "k": self.k,
+            "recent_count": self.recent.maxlen,
+            "recent": [list(row) for row in self.recent],
+            "tops": {
+                window: [key, [list(entry) for entry in heap]]
+                for window, (key, heap) in self.tops.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls(k=data["k"], recent_count=data["recent_count"])
+        summary.recent.extend(tuple(row) for row in data["recent"])
+        for window, (key, heap) in data["tops"].items():
+            summary.tops[window] = [key, [tuple(entry) for entry in heap]]
+        return summary
+
+    @classmethod
+    def from_history(cls, scores, k=5, recent_count=5):
+        # Build a summary from a DataFrame of scores, used the first time an existing history is summarized
+        # Gives the same result as adding every score in time order, but with a sort instead of a Python loop, since histories can have millions of rows
+        summary = cls(k=k, recent_count=recent_count)
+        if len(scores) == 0:
+            return summary
+        scores = scores.sort_values(by=["DateTime", "Score"])
+        timestamps = scores["DateTime"].tolist()
+        summary.recent.extend(
+            zip(timestamps[-recent_count:], scores["Score"].tail(recent_count).tolist())
+        )
+        latest = datetime.strptime(timestamps[-1], timestamp_format)
+        for window in windows:
+            in_window = scores[scores["DateTime"] >= window_start(window, latest)]
+            top = in_window.sort_values(by=["Score", "DateTime"]).tail(k)
+            summary.tops[window] = [
+                window_key(window, timestamps[-1]),
+                list(zip(top["Score"].tolist(), top["DateTime"].tolist())),
+            ]
+            heapq.heapify(summary.tops[window][1])
+        return summary
+
+
+# Use unittest to test the summary against simply sorting all of the scores
+class TestScoreSummary(unittest.TestCase):
+    def test_recent_and_top_scores(self):
+        summary = ScoreSummary(k=3, recent_count=2)
+        rows = [
+            ("2024-04-01 10:00:00", 4),
+            ("2024-04-06 10:00:00", 9),
+            ("2024-04-08 10:00:00", 1),
+            ("2024-04-08 11:00:00", 7),
+            ("2024-04-08 12:00:00", 3),
+            ("2024-04-08 13:00:00", 2),
+        ]
+        for timestamp, score in rows:
+            summary.add(timestamp, score)
+        now = "2024-04-08 14:00:00"
+        self.assertEqual(summary.recent_scores(), rows[:-3:-1])
+        self.assertEqual([s for _, s in summary.top_scores("all", now=now)], [9, 7, 4])
+        self.assertEqual([s for _, s in summary.top_scores("week", now=now)], [7, 3, 2])
+        self.assertEqual(
+            [s for _, s in summary.top_scores("today", now=now)], [7, 3, 2]
+        )
+        self.assertEqual(summary.top_scores("today", now="2024-04-09 08:00:00"), [])
+        copy = ScoreSummary.from_dict(summary.to_dict())
+        self.assertEqual(
+            copy.top_scores("all", now=now), summary.top_scores("all", now=now)
+        )
+        self.assertEqual(copy.recent_scores(), summary.recent_scores())
+        scores = pd.DataFrame(rows[::-1], columns=["DateTime", "Score"])
+        rebuilt = ScoreSummary.from_history(scores, k=3, recent_count=2)
+        self.assertEqual(rebuilt.recent_scores(), summary.recent_scores())
+        for window in windows:
+            self.assertEqual(
+                rebuilt.top_scores(window, now=now), summary.top_scores(window, now=now)
+            )
+
+    def test_window_start(self):
+        now = datetime(2024, 4, 10, 14, 0, 0)
+        self.assertEqual(window_start("today", now), "2024-04-10 00:00:00")
+        self.assertEqual(window_start("week", now), "2024-04-08 00:00:00")
+        self.assertEqual(window_start("all", now), "")
@@ -0,0 +1,223 @@
+import argparse
+import ast
+import asyncio
+import math
+import operator
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import numpy as np
+from problems import batch_problems, generate_batch
+from server import GameServer, raise_open_file_limit
+from storage import open_score_store
+
+# Load generator for server.py: thousands of simulated players on one asyncio loop, each connecting, answering every problem after a random thinking time (right with probability accuracy) until its game is over.
+# Every answer's round trip, from sending the answer to receiving the next problem, is timed with perf_counter, so we get the latency distribution players actually see under load.
+# Run on its own, it starts server.py in a child process, which reports the CPU time it spent serving. That gives the server's CPU use per hosted session: sessions per core is how many players at this pace one fully busy core can host.
+#   python loadgen.py --players 2000 --time-limit 30
+
+binary_operators = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.floordiv,
+    ast.Pow: operator.pow,
+}
+
+
+def solve(problem):
+    # Work out a problem string such as "(3 + 4) x 5 = ", without eval since it comes over the network
+    def evaluate(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, int):
+            return node.value
+        if isinstance(node, ast.BinOp) and type(node.op) in binary_operators:
+            return binary_operators[type(node.op)](
+                evaluate(node.left), evaluate(node.right)
+            )
+        raise ValueError(f"Not a problem: {problem!r}")
+
+    expression = problem.strip().rstrip("=").replace("x", "*").replace("^", "**")
+    return evaluate(ast.parse(expression, mode="eval").body)
+
+
+async def connect(address):
+    # address is (host, port), or a path for a Unix socket
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address)
+
+
+async def play(address, username, rng, latencies, think_time=1.0, accuracy=0.9):
+    # Play one whole game, adding the round trip of every answer to latencies. Returns the final score, or None if the game did not finish
+    reader, writer = await connect(address)
+    try:
+        writer.write(f"{username}\n".encode())
+        line = await reader.readline()
+        while line:
+            fields = line.decode().rstrip("\n").split(" ", 3)
+            if fields[0] == "OVER":
+                return int(fields[1])
+            if fields[0] not in ("START", "RIGHT", "WRONG"):
+                return None
+            delay = rng.expovariate(1 / think_time)
+            if delay >= float(fields[2]):
+                # Still thinking when time runs out
+                line = await reader.readline()
+                continue
+            await asyncio.sleep(delay)
+            answer = solve(fields[3]) if rng.random() < accuracy else -1
+            sent = time.perf_counter()
+            writer.write(f"{answer}\n".encode())
+            line = await reader.readline()
+            if line.startswith((b"RIGHT", b"WRONG")):
+                latencies.append(time.perf_counter() - sent)
+        return None
+    except ConnectionError:
+        return None
+    finally:
+        writer.close()
+
+
+def percentile(values, q):
+    # The q-th percentile (0-100) of values, nearest rank
+    if not values:
+        return math.nan
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+async def run_load(address, players, think_time=1.0, accuracy=0.9, ramp=1.0, seed=0):
+    # Play players games at once, their connections spread evenly over ramp seconds. Returns a summary of the run
+    rng = random.Random(seed)
+    latencies = []
+
+    async def player(i):
+        await asyncio.sleep(ramp * i / players)
+        player_rng = random.Random(rng.getrandbits(64))
+        return await play(
+            address, f"player{i}", player_rng, latencies, think_time, accuracy
+        )
+
+    start = time.perf_counter()
+    scores = await asyncio.gather(*(player(i) for i in range(players)))
+    wall = time.perf_counter() - start
+    return {
+        "players": players,
+        "finished": sum(score is not None for score in scores),
+        "answers": len(latencies),
+        "wall": wall,
+        "answers_per_sec": len(latencies) / wall,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=math.nan) * 1000,
+    }
+
+
+def start_server(time_limit, folder, unix_path=None):
+    # Run server.py in a child process and wait until it is listening, returns the process and its address
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+        "--time-limit",
+        str(time_limit),
+        "--folder",
+        folder,
+    ]
+    command += ["--unix", unix_path] if unix_path else ["--port", "0"]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    address = process.stdout.readline().split()[-1]
+    if unix_path:
+        return process, address
+    host, port = address.rsplit(":", 1)
+    return process, (host, int(port))
+
+
+# Use unittest to test the load generator against a server in the same process
+class TestLoadGenerator(unittest.IsolatedAsyncioTestCase):
+    def test_solve(self):
+        for problem in batch_problems(generate_batch(2000, np.random.default_rng(32))):
+            self.assertEqual(solve(problem.string), problem.solution, problem.string)
+        with self.assertRaises(ValueError):
+            solve("__import__('os') = ")
+
+    async def test_run_load(self):
+        folder = tempfile.mkdtemp()
+        try:
+            store = open_score_store("sqlite", folder)
+            server = GameServer(store, time_limit=0.5, flush_interval=0.05)
+            address = await server.start()
+            summary = await run_load(address, 50, think_time=0.05, ramp=0.1)
+            await server.close()
+            self.assertEqual(summary["finished"], 50)
+            self.assertGreater(summary["answers"], 50)
+            self.assertLessEqual(summary["p50_ms"], summary["p99_ms"])
+            self.assertEqual(len(store.global_top(n=100)), 50)
+            store.close()
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the UltraMac game server")
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--time-limit", type=float, default=30, help="seconds per game")
+    parser.add_argument(
+        "--think-time", type=float, default=1.0, help="mean seconds per answer"
+    )
+    parser.add_argument("--accuracy", type=float, default=0.9)
+    parser.add_argument(
+        "--ramp", type=float, default=5.0, help="seconds over which players connect"
+    )
+    parser.add_argument("--unix", action="store_true", help="use a Unix socket")
+    parser.add_argument(
+        "--connect",
+        help="load test a running server at host:port (or a socket path) instead of starting one",
+    )
+    args = parser.parse_args()
+    raise_open_file_limit()
+
+    folder = tempfile.mkdtemp()
+    process = None
+    try:
+        if args.connect:
+            address = args.connect
+            if ":" in address:
+                host, port = address.rsplit(":", 1)
+                address = (host, int(port))
+        else:
+            unix_path = os.path.join(folder, "server.sock") if args.unix else None
+            process, address = start_server(args.time_limit, folder, unix_path)
+        before = os.times()
+        summary = asyncio.run(
+            run_load(address, args.players, args.think_time, args.accuracy, args.ramp)
+        )
+        after = os.times()
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            # The server's last line is "served <games> games in <seconds> cpu seconds"
+            server_cpu = float(process.stdout.read().split()[-3])
+            process.wait()
+    finally:
+        if process is not None and process.poll() is None:
+            process.kill()
+        shutil.rmtree(folder)
+
+    print(f"players:            {summary['players']} ({summary['finished']} finished)")
+    print(
+        f"answers:            {summary['answers']} ({summary['answers_per_sec']:,.0f}/s)"
+    )
+    print(
+        f"round trip:         p50 {summary['p50_ms']:.2f} ms, p99 {summary['p99_ms']:.2f} ms, max {summary['max_ms']:.2f} ms"
+    )
+    client_cpu = (after.user - before.user) + (after.system - before.system)
+    print(f"load generator CPU: {client_cpu / summary['wall']:.0%} of one core")
+    if process is not None:
+        utilization = server_cpu / summary["wall"]
+        print(f"server CPU:         {utilization:.0%} of one core")
+        print(f"sessions per core:  {summary['players'] / utilization:,.0f}")
@@ -0,0 +1,385 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import accumulate
+import argparse
+import glob
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from files import atomic_write
+from leaderboard import timestamp_format, window_key, windows
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not on Windows, where game windows on one machine should each get their own node name
+
+# Global percentile ranks ("you beat 83% of players") without reading anybody's score history.
+# Every game's score goes into KLL quantile sketches, one per time limit and time window ("today", "week", "all", the same windows as leaderboard.py). A KLL sketch keeps a few hundred of the scores it has seen in levels of compactors: when a level fills up it is sorted and every other score moves up a level, where each counts twice. Adding a score is amortized O(1), the sketch stays a few KB whatever the number of games, and a score's rank comes out within about 1% of the exact one.
+# Sketches merge: merging two sketches gives a sketch of both streams with the same error bound, so separate kiosks or processes each keep their own and an offline merge combines them into one global view.
+# Layout under the percentiles folder: nodes/<node>.json holds the sketches of one kiosk's games (node is the host name by default), and merge_folder writes merged/all.json, the merge of every node, and merged/<node>.json, the merge of every node except that one. A kiosk ranks a score against its own sketch together with merged/<node>.json, so its own latest games count right away and none count twice. Game windows on one machine share its node file and take turns updating it under an flock. Copying the node files between kiosks is left to whatever syncs the data folders.
+
+default_k = 200
+
+
+class KLLSketch:
+    # k sets the accuracy, the rank error is about 1.7 / k
+    def __init__(self, k=default_k, seed=None):
+        self.k = k
+        self.random = random.Random(seed)
+        # compactors[level] holds scores that each stand for 2 ** level scores added
+        self.compactors = [[]]
+        self.n = 0
+        self.size = 0
+        self.max_size = self.capacity(0)
+        # Sorted scores and their cumulative weights, rebuilt on the first rank after a change
+        self.cdf = None
+
+    def capacity(self, level):
+        # The top level holds k scores, every level below it holds 2/3 as many
+        depth = len(self.compactors) - level - 1
+        return max(2, math.ceil(self.k * (2 / 3) ** depth))
+
+    def _grow(self):
+        self.compactors.append([])
+        self.max_size = sum(
+            self.capacity(level) for level in range(len(self.compactors))
+        )
+
+    def _compact(self, level):
+        # Sort the level and move every other score, starting from a random one of the first two, up a level. An odd score out stays
+        items = sorted(self.compactors[level])
+        kept = [items.pop()] if len(items) % 2 else []
+        if level + 1 == len(self.compactors):
+            self._grow()
+        self.compactors[level + 1].extend(items[self.random.randrange(2) :: 2])
+        self.compactors[level] = kept
+
+    def compress(self):
+        # Compact the lowest full levels until the sketch fits in max_size again
+        while self.size >= self.max_size:
+            for level in range(len(self.compactors)):
+                if len(self.compactors[level]) >= self.capacity(level):
+                    self._compact(level)
+                    self.size = sum(len(items) for items in self.compactors)
+                    if self.size < self.max_size:
+                        break
+
+    def update(self, value):
+        self.compactors[0].append(value)
+        self.n += 1
+        self.size += 1
+        self.cdf = None
+        if self.size >= self.max_size:
+            self.compress()
+
+    def merge(self, other):
+        # Add everything other has seen to this sketch
+        if other.k != self.k:
+            raise ValueError(f"Cannot merge sketches with k={self.k} and k={other.k}")
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+        self.n += other.n
+        self.size = sum(len(items) for items in self.compactors)
+        self.cdf = None
+        self.compress()
+        return self
+
+    def copy(self):
+        return KLLSketch.from_dict(self.to_dict())
+
+    def _cdf(self):
+        if self.cdf is None:
+            weighted = sorted(
+                (value, 1 << level)
+                for level, items in enumerate(self.compactors)
+                for value in items
+            )
+            self.cdf = (
+                [value for value, _ in weighted],
+                list(accumulate(weight for _, weight in weighted)),
+            )
+        return self.cdf
+
+    def rank(self, value):
+        # Estimated fraction of the scores added that are below value
+        values, cumulative = self._cdf()
+        i = bisect_left(values, value)
+        return cumulative[i - 1] / cumulative[-1] if i else 0.0
+
+    def quantile(self, q):
+        # Estimated score at fraction q (0-1) of the scores added
+        values, cumulative = self._cdf()
+        if not values:
+            return None
+        return values[min(bisect_left(cumulative, q * cumulative[-1]), len(values) - 1)]
+
+    def to_dict(self):
+        return {"k": self.k, "n": self.n, "compactors": self.compactors}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["k"])
+        sketch.compactors = [list(items) for items in data["compactors"]]
+        sketch.n = data["n"]
+        sketch.size = sum(len(items) for items in sketch.compactors)
+        sketch.max_size = sum(
+            sketch.capacity(level) for level in range(len(sketch.compactors))
+        )
+        return sketch
+
+
+def sketch_key(time_limit, window, timestamp):
+    # Key of the sketch for one time limit and the window a timestamp falls in, such as "120s/today/2024-04-08"
+    return f"{time_limit:g}s/{window}/{window_key(window, timestamp)}"
+
+
+def latest_sketches(sketches):
+    # Only keep the sketch of the latest day and week for every time limit, the windows before it have passed (window keys sort in time order)
+    latest = {}
+    for key in sketches:
+        prefix = key.rsplit("/", 1)[0]
+        if prefix not in latest or key > latest[prefix]:
+            latest[prefix] = key
+    return {key: sketches[key] for key in latest.values()}
+
+
+def load_sketches(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return {key: KLLSketch.from_dict(sketch) for key, sketch in data.items()}
+
+
+def save_sketches(path, sketches):
+    # Written atomically, so readers never see half-written sketches
+    with atomic_write(path) as f:
+        json.dump({key: sketch.to_dict() for key, sketch in sketches.items()}, f)
+
+
+def merge_sketches(groups):
+    # Merge dictionaries of sketches key by key into new sketches
+    merged = {}
+    for sketches in groups:
+        for key, sketch in sketches.items():
+            if key in merged:
+                merged[key].merge(sketch)
+            else:
+                merged[key] = sketch.copy()
+    return latest_sketches(merged)
+
+
+def merge_folder(folder):
+    # Merge every node's sketches into merged/all.json, and into merged/<node>.json without that node's own, returns the global sketches
+    paths = sorted(glob.glob(os.path.join(folder, "nodes", "*.json")))
+    nodes = [os.path.basename(path)[: -len(".json")] for path in paths]
+    groups = [load_sketches(path) for path in paths]
+    # Leaving one node out of each merge with prefix and suffix merges takes O(nodes) merges instead of O(nodes ** 2)
+    prefixes = [{}]
+    for sketches in groups:
+        prefixes.append(merge_sketches([prefixes[-1], sketches]))
+    suffix = {}
+    for i in range(len(groups) - 1, -1, -1):
+        save_sketches(
+            os.path.join(folder, "merged", f"{nodes[i]}.json"),
+            merge_sketches([prefixes[i], suffix]),
+        )
+        suffix = merge_sketches([groups[i], suffix])
+    save_sketches(os.path.join(folder, "merged", "all.json"), prefixes[-1])
+    return prefixes[-1]
+
+
+class ScoreDistribution:
+    # Percentile ranks for the end-of-game screen. node names this kiosk's sketches, the host name by default
+    def __init__(self, folder, node=None, k=default_k):
+        self.folder = folder
+        self.node = node if node is not None else socket.gethostname()
+        self.k = k
+        self.node_file = os.path.join(folder, "nodes", f"{self.node}.json")
+        self.lock_file = os.path.join(folder, "nodes", f"{self.node}.lock")
+        self.sketches = load_sketches(self.node_file)
+        # Every other node's sketches as of the last merge_folder, loaded on the first rank
+        self.others = None
+
+    @contextmanager
+    def locked(self):
+        # flock on nodes/<node>.lock, so game windows on the same machine take turns updating the node file. It has its own file since saving replaces the node file
+        os.makedirs(os.path.dirname(self.lock_file), exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def add(self, time_limit, timestamp, score):
+        # Add one game to this node's sketches and save them. The node file is read again under the lock, so a game another window on this machine saved in the meantime is kept
+        with self.locked():
+            self.sketches = load_sketches(self.node_file)
+            for window in windows:
+                key = sketch_key(time_limit, window, timestamp)
+                if key not in self.sketches:
+                    self.sketches[key] = KLLSketch(self.k)
+                self.sketches[key].update(score)
+            self.sketches = latest_sketches(self.sketches)
+            save_sketches(self.node_file, self.sketches)
+
+    def _others(self):
+        if self.others is None:
+            merged = os.path.join(self.folder, "merged", f"{self.node}.json")
+            if not os.path.exists(merged):
+                # A node that has not been merged yet is not in all.json either
+                merged = os.path.join(self.folder, "merged", "all.json")
+            self.others = load_sketches(merged)
+        return self.others
+
+    def rank(self, time_limit, score, window="all", timestamp=None):
+        # Fraction of the games with this time limit in the window that scored below score, and how many games that is out of
+        if timestamp is None:
+            timestamp = datetime.now().strftime(timestamp_format)
+        key = sketch_key(time_limit, window, timestamp)
+        sketches = [
+            sketch
+            for sketch in (self.sketches.get(key), self._others().get(key))
+            if sketch is not None and sketch.n
+        ]
+        games = sum(sketch.n for sketch in sketches)
+        if not games:
+            return 0.0, 0
+        return sum(sketch.rank(score) * sketch.n for sketch in sketches) / games, games
+
+
+# Use unittest to test the sketch's accuracy against exact ranks, merging, and ranks across nodes
+class TestKLLSketch(unittest.TestCase):
+    def test_rank_error(self):
+        rng = random.Random(32)
+        scores = [int(rng.gauss(60, 20)) for _ in range(100000)]
+        sketch = KLLSketch(seed=32)
+        for score in scores:
+            sketch.update(score)
+        self.assertEqual(sketch.n, len(scores))
+        self.assertLess(sketch.size, 3 * sketch.k)
+        scores.sort()
+        for score in range(0, 121, 10):
+            exact = bisect_left(scores, score) / len(scores)
+            self.assertAlmostEqual(sketch.rank(score), exact, delta=0.02)
+        self.assertAlmostEqual(sketch.quantile(0.5), 60, delta=2)
+        copy = KLLSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+        self.assertEqual(copy.rank(70), sketch.rank(70))
+
+    def test_merge(self):
+        rng = random.Random(32)
+        low, high, both = KLLSketch(seed=1), KLLSketch(seed=2), []
+        for _ in range(20000):
+            score = rng.randrange(50)
+            low.update(score)
+            both.append(score)
+            score = rng.randrange(50, 100)
+            high.update(score)
+            both.append(score)
+        merged = low.copy().merge(high)
+        self.assertEqual(merged.n, 40000)
+        self.assertLess(merged.size, 3 * merged.k)
+        both.sort()
+        for score in range(0, 101, 10):
+            exact = bisect_left(both, score) / len(both)
+            self.assertAlmostEqual(merged.rank(score), exact, delta=0.02)
+        with self.assertRaises(ValueError):
+            low.merge(KLLSketch(k=100))
+
+
+class TestScoreDistribution(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_concurrent_adds_lose_nothing(self):
+        # Two distributions on one node stand for two game windows on one machine
+        windows = [ScoreDistribution(self.folder, "kiosk") for _ in range(2)]
+
+        def play(distribution):
+            for score in range(100):
+                distribution.add(120, "2024-04-08 10:00:00", score)
+
+        threads = [threading.Thread(target=play, args=(w,)) for w in windows]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        fresh = ScoreDistribution(self.folder, "kiosk")
+        self.assertEqual(
+            fresh.rank(120, 1000, timestamp="2024-04-08 11:00:00"), (1.0, 200)
+        )
+
+    def test_ranks_across_nodes(self):
+        kiosks = [ScoreDistribution(self.folder, f"kiosk{i}") for i in range(3)]
+        for score in range(300):
+            kiosks[score % 3].add(120, "2024-04-08 10:00:00", score)
+        kiosks[0].add(20, "2024-04-08 10:00:00", 1000)
+        # Before any merge a kiosk only knows its own games
+        self.assertEqual(
+            kiosks[0].rank(120, 150, timestamp="2024-04-08 11:00:00"), (0.5, 100)
+        )
+        merge_folder(self.folder)
+        # A new game is counted right away, and merged games are not counted twice
+        kiosks[0].add(120, "2024-04-08 12:00:00", 300)
+        for kiosk in kiosks[:2]:
+            kiosk.others = None
+        rank, games = kiosks[0].rank(120, 150, timestamp="2024-04-08 13:00:00")
+        self.assertEqual(games, 301)
+        self.assertAlmostEqual(rank, 150 / 301)
+        self.assertEqual(
+            kiosks[1].rank(120, 150, "today", "2024-04-08 13:00:00")[1], 300
+        )
+        self.assertEqual(
+            kiosks[1].rank(20, 1001, "week", "2024-04-08 13:00:00"), (1.0, 1)
+        )
+        # Yesterday's sketches do not count for today
+        self.assertEqual(
+            kiosks[1].rank(120, 150, "today", "2024-04-09 08:00:00"), (0.0, 0)
+        )
+        kiosks[0].add(120, "2024-04-09 08:00:00", 5)
+        self.assertEqual(
+            sorted(kiosks[0].sketches),
+            [
+                "120s/all/all",
+                "120s/today/2024-04-09",
+                "120s/week/2024-W15",
+                "20s/all/all",
+                "20s/today/2024-04-08",
+                "20s/week/2024-W15",
+            ],
+        )
+        new_kiosk = ScoreDistribution(self.folder, "kiosk3")
+        self.assertEqual(
+            new_kiosk.rank(120, 150, timestamp="2024-04-08 13:00:00")[1], 300
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge the score sketches of every kiosk into one global view and show its percentiles"
+    )
+    parser.add_argument("folder", nargs="?", default="./data/percentiles")
+    args = parser.parse_args()
+    sketches = merge_folder(args.folder)
+    print(f"{'sketch':32} {'games':>10} {'p10':>6} {'p50':>6} {'p90':>6} {'p99':>6}")
+    for key, sketch in sorted(sketches.items()):
+        p10, p50, p90, p99 = (sketch.quantile(q) for q in (0.1, 0.5, 0.9, 0.99))
+        print(f"{key:32} {sketch.n:>10,} {p10:>6} {p50:>6} {p90:>6} {p99:>6}")
@@ -0,0 +1,288 @@
+from collections import namedtuple
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from files import atomic_write
+from problem_table import table_checksum
+from problems import (
+    DIV,
+    POW,
+    Problem,
+    apply_operator,
+    exponent_high,
+    exponent_low,
+    format_problem,
+    generate_batch,
+    max_operands,
+    problem_templates,
+    problem_type_names,
+    solve_batch,
+    type_capped,
+    type_high,
+    type_low,
+)
+
+# The operand spaces of the problem templates are small (operands below upper_bound, multipliers below 12, a handful of powers), so every problem UltraMac can generate fits in one table of about 7.5 million rows.
+# build_index enumerates every problem type into that table, a numpy structured array of the type and the operands (5 bytes per problem), sorted by type and then by operands. It is cached as a .npy file and memory-mapped, so starting a game only reads the pages it actually samples from, and processes share one copy.
+# The rows of a problem type form one contiguous slice, so drawing a problem of a given type uniformly is one random index into its slice. IndexSampler draws problems for one game this way and keeps a bitset per problem type of the problems already served, so no problem repeats within a game.
+# Because the table holds every possible problem, family_stats can report exact solution statistics per problem type instead of guessing them from the bounds.
+
+index_dtype = np.dtype([("type", np.uint8), ("operands", np.uint8, (max_operands,))])
+
+FamilyStats = namedtuple(
+    "FamilyStats", ["name", "count", "mean", "p10", "p50", "p90", "max"]
+)
+
+
+def _expand(low, high):
+    # Enumerate every value in [low[i], high[i]) for every row i, returns the row each value belongs to and the values
+    counts = np.maximum(high - low, 0)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    return rows, low[rows] + np.arange(counts.sum()) - starts[rows]
+
+
+def _operand_range(problem_type, column, left):
+    # Bounds of an operand column for every value on its left, capping subtrahends the same way generate_batch does
+    low = np.full(len(left), type_low[problem_type, column])
+    high = np.full(len(left), type_high[problem_type, column])
+    if type_capped[problem_type, column]:
+        high = np.minimum(high, left + 1)
+        low = np.minimum(low, left)
+    return low, high
+
+
+def enumerate_problems(problem_type):
+    # Every problem of one type that generate_batch can produce, as an (n, max_operands) array sorted by operands
+    template = problem_templates[problem_type]
+    ops = template.ops
+    a = np.arange(type_low[problem_type, 0], type_high[problem_type, 0])
+    if ops[0] == POW:
+        rows, b = _expand(exponent_low[a], exponent_high[a])
+    else:
+        rows, b = _expand(*_operand_range(problem_type, 1, a))
+    a = a[rows]
+    value = apply_operator(ops[0], a * b if ops[0] == DIV else a, b)
+    columns = [a * b if ops[0] == DIV else a, b]
+    if template.shape == "pairs":
+        # The right pair (c op d) does not depend on the left one, so every left pair is combined with every right pair
+        c = np.arange(type_low[problem_type, 2], type_high[problem_type, 2])
+        rows, d = _expand(*_operand_range(problem_type, 3, c))
+        c = c[rows]
+        left = np.repeat(np.arange(len(value)), len(c))
+        right = np.tile(np.arange(len(c)), len(value))
+        columns = [columns[0][left], columns[1][left], c[right], d[right]]
+    else:
+        for column, op in enumerate(ops[1:], start=2):
+            rows, operand = _expand(*_operand_range(problem_type, column, value))
+            columns = [values[rows] for values in columns] + [operand]
+            value = apply_operator(op, value[rows], operand)
+    operands = np.zeros((len(columns[0]), max_operands), dtype=np.uint8)
+    for column, values in enumerate(columns):
+        operands[:, column] = values
+    # Division stores the dividend a x b first, which is not in order yet
+    return operands[np.lexsort(operands.T[::-1])]
+
+
+def build_index():
+    # Enumerate every problem type into one table sorted by type
+    families = [enumerate_problems(i) for i in range(len(problem_templates))]
+    index = np.empty(sum(len(family) for family in families), dtype=index_dtype)
+    start = 0
+    for problem_type, family in enumerate(families):
+        index["type"][start : start + len(family)] = problem_type
+        index["operands"][start : start + len(family)] = family
+        start += len(family)
+    return index
+
+
+def index_file(folder):
+    # The file name includes the problem table's checksum, so the index is rebuilt if the table ever changes
+    return os.path.join(folder, f"problem-index-{table_checksum:08x}.npy")
+
+
+class ProblemIndex:
+    def __init__(self, table):
+        self.table = table
+        # Row offsets of each problem type's slice, found by binary search since the table is sorted by type
+        self.offsets = np.searchsorted(
+            table["type"], np.arange(len(problem_templates) + 1)
+        )
+        self.counts = np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.table)
+
+    def family(self, problem_type):
+        # Operands of every problem of one type
+        start, end = self.offsets[problem_type], self.offsets[problem_type + 1]
+        return self.table["operands"][start:end]
+
+    def problems(self, types, positions):
+        # Problems at the given positions within their type's slice
+        types = np.asarray(types, dtype=np.int64)
+        operands = self.table["operands"][self.offsets[types] + positions].astype(
+            np.int64
+        )
+        solutions = solve_batch(types, operands)
+        return [
+            Problem(
+                problem_type,
+                row,
+                format_problem(problem_type, row),
+                solution,
+                problem_templates[problem_type].score,
+            )
+            for problem_type, row, solution in zip(
+                types.tolist(), operands.tolist(), solutions.tolist()
+            )
+        ]
+
+    def sampler(self, scheduler=None):
+        return IndexSampler(self, scheduler)
+
+
+def load_index(folder):
+    # Memory-map the cached problem index, building and caching it first if needed
+    path = index_file(folder)
+    if not os.path.exists(path):
+        # Written atomically, so other processes never map a half-written index
+        with atomic_write(path, "wb") as f:
+            np.save(f, build_index())
+    return ProblemIndex(np.load(path, mmap_mode="r"))
+
+
+class IndexSampler:
+    # Draws the problems of one game from a ProblemIndex without repeats. Works as the generate function of a ProblemQueue
+    # Problem types are drawn uniformly like generate_batch does, or with the scheduler if there is one (see scheduler.py)
+    def __init__(self, index, scheduler=None):
+        self.index = index
+        self.scheduler = scheduler
+        # One bitset per problem type, only allocated once that type is drawn, and how many of its problems were served
+        self.seen = {}
+        self.served = np.zeros(len(problem_templates), dtype=np.int64)
+
+    def _seen(self, problem_type):
+        if problem_type not in self.seen:
+            count = int(self.index.counts[problem_type])
+            self.seen[problem_type] = np.zeros((count + 7) // 8, dtype=np.uint8)
+        return self.seen[problem_type]
+
+    def draw(self, rng, problem_type):
+        # One unseen position within a problem type's slice. Once every problem of a type has been served, that type starts over
+        count = int(self.index.counts[problem_type])
+        seen = self._seen(problem_type)
+        if self.served[problem_type] == count:
+            seen[:] = 0
+            self.served[problem_type] = 0
+        while True:
+            position = int(rng.integers(count))
+            byte, bit = divmod(position, 8)
+            if not seen[byte] & (128 >> bit):
+                seen[byte] |= 128 >> bit
+                self.served[problem_type] += 1
+                return position
+
+    def __call__(self, n, rng):
+        if self.scheduler is not None:
+            types = self.scheduler.sample(rng, n)
+        else:
+            types = rng.integers(0, len(problem_templates), size=n)
+        positions = [self.draw(rng, problem_type) for problem_type in types.tolist()]
+        return self.index.problems(types, np.array(positions, dtype=np.int64))
+
+
+def family_stats(index):
+    # Exact statistics of the solutions of every problem type
+    stats = []
+    for problem_type, name in enumerate(problem_type_names):
+        operands = index.family(problem_type)
+        solutions = solve_batch(np.full(len(operands), problem_type), operands)
+        p10, p50, p90 = np.percentile(solutions, [10, 50, 90])
+        stats.append(
+            FamilyStats(
+                name,
+                len(solutions),
+                float(solutions.mean()),
+                float(p10),
+                float(p50),
+                float(p90),
+                int(solutions.max()),
+            )
+        )
+    return stats
+
+
+# Use unittest to test that the index holds exactly the problems generate_batch can produce and that samplers never repeat a problem
+class TestProblemIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.index = load_index(cls.folder)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def test_index_is_cached_and_memory_mapped(self):
+        self.assertIsInstance(self.index.table, np.memmap)
+        self.assertEqual(
+            os.listdir(self.folder), [os.path.basename(self.index.table.filename)]
+        )
+        self.assertEqual(self.index.counts.sum(), len(self.index))
+        self.assertEqual(self.index.counts[problem_type_names.index("addition")], 35**2)
+
+    def test_generated_problems_are_in_the_index(self):
+        # Operands are sorted within each family, so membership is a binary search over the operands packed into one integer
+        weights = 256 ** np.arange(max_operands - 1, -1, -1)
+        batch = generate_batch(20000, np.random.default_rng(32))
+        for problem_type in range(len(problem_templates)):
+            keys = self.index.family(problem_type).astype(np.int64) @ weights
+            self.assertTrue((np.diff(keys) > 0).all())
+            generated = batch.operands[batch.types == problem_type] @ weights
+            found = keys[np.searchsorted(keys, generated).clip(0, len(keys) - 1)]
+            np.testing.assert_array_equal(found, generated)
+
+    def test_sampler_does_not_repeat(self):
+        sampler = self.index.sampler()
+        rng = np.random.default_rng(32)
+        problems = sampler(200, rng)
+        strings = [problem.string for problem in problems]
+        self.assertEqual(len(set(strings)), len(strings))
+        for problem in problems:
+            expression = (
+                problem.string.rstrip("= ").replace("x", "*").replace("^", "**")
+            )
+            self.assertEqual(eval(expression.replace("/", "//")), problem.solution)
+        # Exponentiation only has 11 problems, all of them come up before any repeats and then they start over
+        sampler = self.index.sampler()
+        exponentiation = problem_type_names.index("exponentiation")
+        positions = [sampler.draw(rng, exponentiation) for _ in range(22)]
+        self.assertEqual(sorted(positions[:11]), list(range(11)))
+        self.assertEqual(sorted(positions[11:]), list(range(11)))
+
+    def test_family_stats(self):
+        stats = {row.name: row for row in family_stats(self.index)}
+        self.assertEqual(stats["multiplication"].max, 121)
+        self.assertEqual(stats["addition"].mean, 36)
+        self.assertEqual(stats["exponentiation"].count, 11)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the UltraMac problem index and show the solution statistics of every problem type"
+    )
+    parser.add_argument("folder", nargs="?", default="./data/index")
+    args = parser.parse_args()
+    index = load_index(args.folder)
+    print(f"{len(index):,} problems in {index_file(args.folder)}\n")
+    print(
+        f"{'problem type':48} {'count':>10} {'mean':>8} {'p10':>6} {'p50':>6} {'p90':>6} {'max':>6}"
+    )
+    for row in family_stats(index):
+        print(
+            f"{row.name:48} {row.count:>10,} {row.mean:>8.1f} {row.p10:>6.0f} {row.p50:>6.0f} {row.p90:>6.0f} {row.max:>6}"
+        )
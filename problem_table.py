@@ -0,0 +1,169 @@
+from collections import namedtuple
+import operator
+import zlib
+
+# The table of UltraMac's problem types, in plain Python so that the first problem of a game can be drawn (with draw_problem) without importing numpy. problems.py builds its vectorized generator on top of this table.
+# The base problems (consisting of just one operation) are designed to be approximately of similar difficulty in terms of mental math, so that they are all worth the same score. We do this by adjusting the upper bounds of the random numbers that are generated for each operation so that the difficulty is similar. Ex: Addition has a larger upper bound than multiplication, since multiplication is more difficult. Similarly, exponentiation has a smaller upper bound than multiplication, since exponentiation is more difficult.
+# For all the problems that involve subtraction, we want to ensure that the result is non-negative. So, every subtrahend is drawn with its upper bound capped at the value it is subtracted from.
+# For division, we want to ensure that the result is an integer, so we multiply two numbers together to get a bigger number that is for sure divisible by the second number. Division is only used as a base problem.
+# We also do not include exponentiation when creating compound problems because they would be generally infeasible to solve using mental math in compound problems.
+
+lower_bound = 1
+upper_bound = 36
+
+# Operators are stored as small integer codes so that a batch can be evaluated with np.select
+ADD, SUB, MUL, DIV, POW, NOP = range(6)
+operator_symbols = {ADD: "+", SUB: "-", MUL: "x", DIV: "/", POW: "^"}
+
+# Default (low, high) bounds for the operands of each operator, high is exclusive like np.random.randint
+operand_bounds = {
+    ADD: (lower_bound, upper_bound),
+    SUB: (lower_bound, upper_bound),
+    MUL: (lower_bound, upper_bound // 3),
+    DIV: (lower_bound, upper_bound // 3),
+    POW: (2, 10),
+}
+
+# Exponents depend on the base so that the power stays doable in one's head: bases 2-4 get exponent 3 or 4, bases 5-9 get exponent 2
+exponent_low = (0, 0, 3, 3, 3, 2, 2, 2, 2, 2)
+exponent_high = (1, 1, 5, 5, 5, 3, 3, 3, 3, 3)
+
+# Problems use at most three operations, so four operand columns
+max_operands = 4
+
+# shape is "chain" for ((a op b) op c) op d and "pairs" for (a op b) op (c op d)
+# capped marks the operands that are subtrahends, these get their upper bound capped at the value they are subtracted from so the result is never negative
+# We reward a higher score for compound problems, since they are more difficult. We increase score by one for each operation in the compound problem. So, a compound problem with 3 operations is worth 3 points, and a compound problem with 2 operations is worth 2 points.
+ProblemTemplate = namedtuple(
+    "ProblemTemplate", ["name", "ops", "shape", "bounds", "capped", "score"]
+)
+
+
+def make_template(name, ops, shape="chain"):
+    # Build a template whose operand bounds and non-negativity constraints follow from its operators
+    if shape == "pairs":
+        # (a op0 b) op1 (c op2 d): a and b belong to op0, c and d belong to op2
+        if ops[1] == SUB:
+            raise ValueError(f"{name}: pairs problems cannot subtract the right pair")
+        owners = [ops[0], ops[0], ops[2], ops[2]]
+        capped = (False, ops[0] == SUB, False, ops[2] == SUB)
+    else:
+        # ((a op0 b) op1 c) op2 d: the first operand belongs to op0, every other operand to the operator before it
+        owners = [ops[0]] + list(ops)
+        capped = (False,) + tuple(op == SUB for op in ops)
+    if DIV in ops[1:] or POW in ops[1:]:
+        raise ValueError(f"{name}: division and exponentiation are base problems only")
+    bounds = tuple(operand_bounds[op] for op in owners)
+    return ProblemTemplate(name, tuple(ops), shape, bounds, capped, len(ops))
+
+
+problem_templates = [
+    make_template("addition", [ADD]),
+    make_template("subtraction", [SUB]),
+    make_template("multiplication", [MUL]),
+    make_template("division", [DIV]),
+    make_template("exponentiation", [POW]),
+    make_template("compound_add_then_multiply", [ADD, MUL]),
+    make_template("compound_multiply_then_add", [MUL, ADD]),
+    make_template("compound_add_then_subtract", [ADD, SUB]),
+    make_template("compound_subtract_then_add", [SUB, ADD]),
+    make_template("compound_subtract_then_multiply", [SUB, MUL]),
+    make_template("compound_multiply_then_subtract", [MUL, SUB]),
+    make_template("compound_add_then_add", [ADD, ADD]),
+    make_template("compound_multiply_then_multiply", [MUL, MUL]),
+    make_template("compound_add_then_add_then_add", [ADD, ADD, ADD], "pairs"),
+    make_template(
+        "compound_multiply_then_multiply_then_multiply", [MUL, MUL, MUL], "pairs"
+    ),
+    make_template("compound_add_then_add_then_subtract", [ADD, ADD, SUB], "pairs"),
+    make_template("compound_subtract_then_add_then_add", [SUB, ADD, ADD], "pairs"),
+    make_template("compound_add_then_subtract_then_multiply", [ADD, SUB, MUL]),
+    make_template("compound_subtract_then_add_then_multiply", [SUB, ADD, MUL]),
+    make_template("compound_subtract_then_multiply_then_add", [SUB, MUL, ADD]),
+    make_template("compound_multiply_then_subtract_then_add", [MUL, SUB, ADD]),
+    make_template("compound_multiply_then_multiply_then_subtract", [MUL, MUL, SUB]),
+    make_template("compound_multiply_then_subtract_then_multiply", [MUL, SUB, MUL]),
+    make_template("compound_subtract_then_multiply_then_multiply", [SUB, MUL, MUL]),
+    make_template("compound_subtract_then_multiply_then_subtract", [SUB, MUL, SUB]),
+    make_template("compound_add_then_multiply_then_add", [ADD, MUL, ADD]),
+    make_template("compound_add_then_multiply_then_subtract", [ADD, MUL, SUB]),
+    make_template("compound_add_then_subtract_then_add", [ADD, SUB, ADD]),
+    make_template("compound_multiply_then_add_then_multiply", [MUL, ADD, MUL]),
+    make_template("compound_multiply_then_add_then_add", [MUL, ADD, ADD]),
+    make_template("compound_subtract_then_add_then_subtract", [SUB, ADD, SUB]),
+]
+problem_type_names = [template.name for template in problem_templates]
+# Problem types are stored as indexes into problem_templates in cached decks and the problem index, so their file names include this checksum of the type names, and they are rebuilt if the table ever changes
+table_checksum = zlib.crc32(",".join(problem_type_names).encode())
+
+# One problem ready to be shown, with its problem string already built
+Problem = namedtuple("Problem", ["type", "operands", "string", "solution", "score"])
+
+
+def format_problem(problem_type, operands):
+    # Build the problem string shown to the player, such as "((3 + 4) - 2) x 5 = "
+    template = problem_templates[problem_type]
+    symbols = [operator_symbols[op] for op in template.ops]
+    values = [int(value) for value in operands[: len(template.bounds)]]
+    if len(symbols) == 1:
+        return f"{values[0]} {symbols[0]} {values[1]} = "
+    if template.shape == "pairs":
+        a, b, c, d = values
+        return f"({a} {symbols[0]} {b}) {symbols[1]} ({c} {symbols[2]} {d}) = "
+    expression = f"{values[0]} {symbols[0]} {values[1]}"
+    for symbol, value in zip(symbols[1:], values[2:]):
+        expression = f"({expression}) {symbol} {value}"
+    return f"{expression} = "
+
+
+# The function of each operator code, for evaluating one problem at a time
+operator_functions = {
+    ADD: operator.add,
+    SUB: operator.sub,
+    MUL: operator.mul,
+    DIV: operator.floordiv,
+    POW: operator.pow,
+}
+
+
+def _draw_operand(random, bounds, capped, left):
+    # One operand in [low, high), with a subtrahend capped at the value on its left like generate_batch does
+    low, high = bounds
+    if capped:
+        low, high = min(low, left), min(high, left + 1)
+    return random.randrange(low, high)
+
+
+def draw_problem(random, problem_type=None):
+    # Draw one problem with a random.Random, following the same rules as generate_batch in problems.py but without numpy
+    if problem_type is None:
+        problem_type = random.randrange(len(problem_templates))
+    template = problem_templates[problem_type]
+    ops, bounds, capped = template.ops, template.bounds, template.capped
+    a = random.randrange(*bounds[0])
+    if ops[0] == POW:
+        b = random.randrange(exponent_low[a], exponent_high[a])
+    else:
+        b = _draw_operand(random, bounds[1], capped[1], a)
+    if ops[0] == DIV:
+        a *= b
+    operands = [a, b]
+    value = operator_functions[ops[0]](a, b)
+    if template.shape == "pairs":
+        c = random.randrange(*bounds[2])
+        d = _draw_operand(random, bounds[3], capped[3], c)
+        operands += [c, d]
+        value = operator_functions[ops[1]](value, operator_functions[ops[2]](c, d))
+    else:
+        for op, operand_bounds, operand_capped in zip(ops[1:], bounds[2:], capped[2:]):
+            operand = _draw_operand(random, operand_bounds, operand_capped, value)
+            operands.append(operand)
+            value = operator_functions[op](value, operand)
+    operands += [0] * (max_operands - len(operands))
+    return Problem(
+        problem_type,
+        operands,
+        format_problem(problem_type, operands),
+        value,
+        template.score,
+    )
@@ -0,0 +1,297 @@
+from collections import namedtuple
+import threading
+import unittest
+import numpy as np
+from problem_table import (
+    ADD,
+    DIV,
+    MUL,
+    NOP,
+    POW,
+    SUB,
+    Problem,
+    ProblemTemplate,
+    format_problem,
+    lower_bound,
+    make_template,
+    max_operands,
+    operand_bounds,
+    operator_symbols,
+    problem_templates,
+    problem_type_names,
+    upper_bound,
+)
+from problem_table import exponent_high as _exponent_high
+from problem_table import exponent_low as _exponent_low
+
+# Problem generation for UltraMac, driven by the table of problem types in problem_table.py so that a whole batch of problems can be drawn with a handful of vectorized numpy calls instead of one if/elif branch (and several np.random.randint calls) per problem.
+
+# Exponent bounds by base, as arrays for fancy indexing
+exponent_low = np.array(_exponent_low)
+exponent_high = np.array(_exponent_high)
+
+
+def _build_columns(templates):
+    # Flatten the templates into per-type columns so a batch can look up its bounds with fancy indexing
+    n_types = len(templates)
+    ops = np.full((n_types, max_operands - 1), NOP, dtype=np.int8)
+    low = np.zeros((n_types, max_operands), dtype=np.int64)
+    high = np.ones((n_types, max_operands), dtype=np.int64)
+    capped = np.zeros((n_types, max_operands), dtype=bool)
+    for i, template in enumerate(templates):
+        ops[i, : len(template.ops)] = template.ops
+        for j, (lo, hi) in enumerate(template.bounds):
+            low[i, j], high[i, j] = lo, hi
+        capped[i, : len(template.capped)] = template.capped
+    pairs = np.array([template.shape == "pairs" for template in templates])
+    n_operands = np.array([len(template.bounds) for template in templates])
+    scores = np.array([template.score for template in templates], dtype=np.int64)
+    return ops, low, high, capped, pairs, n_operands, scores
+
+
+(
+    type_ops,
+    type_low,
+    type_high,
+    type_capped,
+    type_pairs,
+    type_n_operands,
+    type_scores,
+) = _build_columns(problem_templates)
+
+# Columnar batch of problems: types indexes problem_templates, operands has one row of max_operands per problem (unused columns are 0)
+ProblemBatch = namedtuple("ProblemBatch", ["types", "operands", "solutions", "scores"])
+
+
+def _draw(u, low, high, capped, left):
+    # Turn uniform floats into integer operands in [low, high), with subtrahends capped at the value on their left
+    high = np.where(capped, np.minimum(high, left + 1), high)
+    low = np.where(capped, np.minimum(low, left), low)
+    return low + np.floor(u * (high - low)).astype(np.int64)
+
+
+def apply_operator(op, left, right):
+    # Evaluate one operator column for the whole batch, NOP leaves the left value untouched
+    # Rows with other operators see a harmless divisor and exponent so that np.select can evaluate every branch
+    divisor = np.where(op == DIV, right, 1)
+    exponent = np.where(op == POW, right, 1)
+    return np.select(
+        [op == ADD, op == SUB, op == MUL, op == DIV, op == POW],
+        [left + right, left - right, left * right, left // divisor, left**exponent],
+        default=left,
+    )
+
+
+def generate_batch(n, rng, types=None):
+    # Generate n problems at once, drawing all of the randomness in two calls: one for the problem types and one for the operands
+    # types can be given as an array of indexes into problem_templates to generate specific problem types, otherwise they are chosen uniformly
+    if types is None:
+        types = rng.integers(0, len(problem_templates), size=n)
+    else:
+        types = np.broadcast_to(np.asarray(types, dtype=np.int64), (n,))
+    u = rng.random((n, max_operands))
+    ops = type_ops[types]
+    low = type_low[types]
+    high = type_high[types]
+    capped = type_capped[types]
+    pairs = type_pairs[types]
+    operands = np.zeros((n, max_operands), dtype=np.int64)
+
+    # First operation: a op0 b
+    a = _draw(u[:, 0], low[:, 0], high[:, 0], False, 0)
+    is_pow = ops[:, 0] == POW
+    base = np.where(is_pow, a, 2)
+    b_low = np.where(is_pow, exponent_low[base], low[:, 1])
+    b_high = np.where(is_pow, exponent_high[base], high[:, 1])
+    b = _draw(u[:, 1], b_low, b_high, capped[:, 1], a)
+    # Division is built from a product so the quotient is always an integer
+    a = np.where(ops[:, 0] == DIV, a * b, a)
+    operands[:, 0] = a
+    operands[:, 1] = b
+    first = apply_operator(ops[:, 0], a, b)
+
+    # Chains feed the running value into the next operation, pairs build an independent right-hand pair (c op2 d)
+    c = _draw(u[:, 2], low[:, 2], high[:, 2], capped[:, 2], first)
+    chain = apply_operator(ops[:, 1], first, c)
+    d = _draw(u[:, 3], low[:, 3], high[:, 3], capped[:, 3], np.where(pairs, c, chain))
+    chain = apply_operator(ops[:, 2], chain, d)
+    right_pair = apply_operator(ops[:, 2], c, d)
+    solutions = np.where(pairs, apply_operator(ops[:, 1], first, right_pair), chain)
+
+    n_operands = type_n_operands[types]
+    operands[:, 2] = np.where(n_operands > 2, c, 0)
+    operands[:, 3] = np.where(n_operands > 3, d, 0)
+    return ProblemBatch(types, operands, solutions, type_scores[types])
+
+
+def solve_batch(types, operands):
+    # Solutions of already drawn problems, given their types and operands in the same layout generate_batch returns them
+    types = np.asarray(types, dtype=np.int64)
+    operands = np.asarray(operands, dtype=np.int64)
+    ops = type_ops[types]
+    a, b, c, d = operands.T
+    first = apply_operator(ops[:, 0], a, b)
+    chain = apply_operator(ops[:, 2], apply_operator(ops[:, 1], first, c), d)
+    right_pair = apply_operator(ops[:, 2], c, d)
+    return np.where(
+        type_pairs[types], apply_operator(ops[:, 1], first, right_pair), chain
+    )
+
+
+def generate_problem(rng):
+    # Generate a single random quick math problem, returned as (problem string, solution, score)
+    batch = generate_batch(1, rng)
+    problem_string = format_problem(batch.types[0], batch.operands[0])
+    return problem_string, int(batch.solutions[0]), int(batch.scores[0])
+
+
+def batch_problems(batch):
+    # Split a batch into a list of Problems, converting to plain Python ints once for the whole batch
+    return [
+        Problem(
+            problem_type,
+            operands,
+            format_problem(problem_type, operands),
+            solution,
+            score,
+        )
+        for problem_type, operands, solution, score in zip(
+            batch.types.tolist(),
+            batch.operands.tolist(),
+            batch.solutions.tolist(),
+            batch.scores.tolist(),
+        )
+    ]
+
+
+class ProblemQueue:
+    # Bounded ring buffer of ready-to-show problems, so moving on to the next problem is a constant-time pop instead of generating one while the player waits
+    # The queue is topped up a chunk at a time with generate_batch, either from Tk's idle callbacks (see UltraMac.schedule_refill) or from a background thread. If it ever runs dry, pop generates a chunk on the spot
+    # With a scheduler (see scheduler.py), problem types are drawn with scheduler.sample instead of uniformly
+    # generate can replace generate_batch entirely: it is called as generate(n, rng) and returns a list of n Problems, see expressions.generate_expressions
+    def __init__(self, rng, capacity=256, chunk_size=64, scheduler=None, generate=None):
+        self.rng = rng
+        self.scheduler = scheduler
+        self.generate = generate
+        self.capacity = capacity
+        self.chunk_size = min(chunk_size, capacity)
+        self.buffer = [None] * capacity
+        self.head = 0
+        self.count = 0
+        self.lock = threading.Lock()  # Protects the ring buffer
+        self.generate_lock = (
+            threading.Lock()
+        )  # The numpy Generator must not be used by two threads at once
+        self.refill_thread = None
+
+    def __len__(self):
+        return self.count
+
+    def needs_refill(self):
+        # True when there is room for another whole chunk
+        return self.capacity - self.count >= self.chunk_size
+
+    def pop(self):
+        if self.count == 0:
+            self.refill()
+        with self.lock:
+            problem = self.buffer[self.head]
+            self.buffer[self.head] = None
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+        return problem
+
+    def refill(self):
+        # Generate one chunk of problems into the free slots, returns how many were added
+        with self.generate_lock:
+            n = min(self.chunk_size, self.capacity - self.count)
+            if n <= 0:
+                return 0
+            if self.generate is not None:
+                problems = self.generate(n, self.rng)
+            else:
+                types = None
+                if self.scheduler is not None:
+                    types = self.scheduler.sample(self.rng, n)
+                problems = batch_problems(generate_batch(n, self.rng, types=types))
+        with self.lock:
+            problems = problems[: self.capacity - self.count]
+            for problem in problems:
+                self.buffer[(self.head + self.count) % self.capacity] = problem
+                self.count += 1
+        return len(problems)
+
+    def fill(self):
+        # Refill until the queue is full
+        while self.refill():
+            pass
+
+    def fill_in_background(self):
+        # Fill the queue from a background thread, unless one is already running
+        if self.refill_thread is None or not self.refill_thread.is_alive():
+            self.refill_thread = threading.Thread(target=self.fill, daemon=True)
+            self.refill_thread.start()
+
+
+# Use unittest to test generate_batch, specifically making sure that every solution is a non-negative integer that matches its problem string
+class TestGenerateBatch(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(32)
+
+    def test_solutions_match_problem_strings(self):
+        batch = generate_batch(10000, self.rng)
+        self.assertTrue((batch.solutions >= 0).all(), "Solution is negative")
+        for i in range(len(batch.types)):
+            problem_string = format_problem(batch.types[i], batch.operands[i])
+            expression = (
+                problem_string.rstrip("= ").replace("x", "*").replace("^", "**")
+            ).replace("/", "//")
+            self.assertEqual(eval(expression), batch.solutions[i], problem_string)
+
+    def test_every_type_and_score(self):
+        for i, template in enumerate(problem_templates):
+            batch = generate_batch(500, self.rng, types=i)
+            self.assertTrue((batch.solutions >= 0).all(), template.name)
+            self.assertTrue((batch.scores == template.score).all(), template.name)
+
+    def test_solve_batch(self):
+        batch = generate_batch(10000, self.rng)
+        np.testing.assert_array_equal(
+            solve_batch(batch.types, batch.operands), batch.solutions
+        )
+
+    def test_generate_problem(self):
+        problem_string, solution, score = generate_problem(self.rng)
+        self.assertIsInstance(solution, int, "Solution is not an integer")
+        self.assertIn(score, (1, 2, 3))
+        self.assertTrue(problem_string.endswith("= "))
+
+
+# Use unittest to test the problem queue, specifically that problems come out in order as the ring buffer wraps around
+class TestProblemQueue(unittest.TestCase):
+    def test_pop_order_and_refill(self):
+        queue = ProblemQueue(np.random.default_rng(32), capacity=10, chunk_size=4)
+        expected = batch_problems(generate_batch(4, np.random.default_rng(32)))
+        self.assertEqual(
+            queue.pop(), expected[0]
+        )  # Empty queue generates a chunk on the spot
+        self.assertEqual(len(queue), 3)
+        queue.fill()
+        self.assertEqual(len(queue), 10)
+        self.assertFalse(queue.needs_refill())
+        popped = []
+        for _ in range(25):
+            if queue.needs_refill():
+                queue.refill()
+            popped.append(queue.pop())
+        self.assertEqual(popped[:3], expected[1:])
+        for problem in popped:
+            self.assertEqual(
+                problem.string, format_problem(problem.type, problem.operands)
+            )
+
+    def test_background_fill(self):
+        queue = ProblemQueue(np.random.default_rng(32), capacity=100, chunk_size=16)
+        queue.fill_in_background()
+        queue.refill_thread.join()
+        self.assertEqual(len(queue), 100)
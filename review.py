@@ -0,0 +1,259 @@
+import heapq
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+from decks import DeckSource, build_deck
+from engine import GameSession
+from files import atomic_write
+from problems import (
+    Problem,
+    format_problem,
+    max_operands,
+    problem_templates,
+    problem_type_names,
+    solve_batch,
+)
+
+# Spaced repetition of the exact problems a player got wrong: a missed "7 x 8 = " comes back later in the game, and again in later games, until it has been answered right a few times in a row.
+# Every missed problem (its type and operands) goes into the user's ReviewQueue in the first of the Leitner boxes below. A right answer moves it up one box, so it comes back after a longer interval, a wrong one sends it back to the first box, and a right answer in the last box retires it.
+# The items are kept in a heap ordered by due time, so finding the next due item is O(1) and updating one is O(log n). Moving an item leaves its old heap entry behind, entries whose due time no longer matches the item are skipped when they reach the top.
+# A game serves a fraction of its problems from the items that are due, see ReviewSource. Due times are wall clock time, so they carry over between games. The queue is saved as data/<username>.review.npy next to the score history, 14 bytes per item.
+
+# Seconds until an item in each box is due again, the first box comes back within the same game
+box_intervals = (30, 600, 86400, 3 * 86400, 7 * 86400, 30 * 86400)
+default_review_fraction = 0.25
+
+review_dtype = np.dtype(
+    [
+        ("type", np.uint8),
+        ("operands", np.uint8, (max_operands,)),
+        ("box", np.uint8),
+        ("due", np.float64),
+    ]
+)
+
+
+def review_problem(problem_type, operands):
+    # The Problem for a review item, operands are padded with zeros like generated problems
+    operands = (list(operands) + [0] * max_operands)[:max_operands]
+    solution = solve_batch(np.array([problem_type]), np.array([operands]))[0]
+    return Problem(
+        problem_type,
+        operands,
+        format_problem(problem_type, operands),
+        int(solution),
+        problem_templates[problem_type].score,
+    )
+
+
+class ReviewQueue:
+    # fraction is how many of the problems of a game come from due items (when there are any), clock is the wall clock in seconds
+    def __init__(self, fraction=default_review_fraction, clock=time.time):
+        self.fraction = fraction
+        self.clock = clock
+        # (type, operands) of every item, mapped to its box and due time
+        self.items = {}
+        self.heap = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def _schedule(self, key, box, now):
+        due = now + box_intervals[box]
+        self.items[key] = (box, due)
+        heapq.heappush(self.heap, (due, key))
+
+    def update(self, problem, correct, now=None):
+        # Learn from one answer: a miss goes (back) into the first box, a right answer to an item moves it up a box
+        now = self.clock() if now is None else now
+        key = (problem.type, tuple(problem.operands))
+        if not correct:
+            self._schedule(key, 0, now)
+        elif key in self.items:
+            box = self.items[key][0] + 1
+            if box == len(box_intervals):
+                del self.items[key]  # Learned, its heap entry is skipped from now on
+            else:
+                self._schedule(key, box, now)
+
+    def pop_due(self, now=None):
+        # The earliest item that is due, or None. The item stays in the queue until it is answered, just not in the heap
+        now = self.clock() if now is None else now
+        while self.heap and self.heap[0][0] <= now:
+            due, key = heapq.heappop(self.heap)
+            if key in self.items and self.items[key][1] == due:
+                return key
+        return None
+
+    def source(self, problems, random):
+        # Serve the problems of a game from this queue and problems, see ReviewSource
+        return ReviewSource(self, problems, random)
+
+    def to_array(self):
+        items = np.empty(len(self.items), dtype=review_dtype)
+        for i, ((problem_type, operands), (box, due)) in enumerate(self.items.items()):
+            items[i] = (problem_type, operands, box, due)
+        return items
+
+    @classmethod
+    def from_array(cls, items, fraction=default_review_fraction, clock=time.time):
+        queue = cls(fraction, clock)
+        for problem_type, operands, box, due in items.tolist():
+            if problem_type >= len(problem_type_names):
+                continue  # Problem type that no longer exists
+            key = (problem_type, tuple(operands))
+            queue.items[key] = (box, due)
+            queue.heap.append((due, key))
+        heapq.heapify(queue.heap)
+        return queue
+
+
+class ReviewSource:
+    # Serves a due review item with probability fraction, otherwise the next problem of problems. Works as the problems of a GameSession in place of a ProblemQueue
+    # random is a random.Random, so the first problem of a game is still served without numpy
+    def __init__(self, review, problems, random):
+        self.review = review
+        self.problems = problems
+        self.random = random
+
+    def __len__(self):
+        return len(self.problems)
+
+    def needs_refill(self):
+        return self.problems.needs_refill()
+
+    def refill(self):
+        return self.problems.refill()
+
+    def fill(self):
+        self.problems.fill()
+
+    def pop(self):
+        if self.random.random() < self.review.fraction:
+            key = self.review.pop_due()
+            if key is not None:
+                return review_problem(*key)
+        return self.problems.pop()
+
+
+def review_file(folder, username):
+    return os.path.join(folder, f"{username}.review.npy")
+
+
+def load_review(folder, username, fraction=default_review_fraction):
+    # The user's saved review queue, or an empty one for a new user
+    try:
+        items = np.load(review_file(folder, username))
+    except (FileNotFoundError, ValueError):
+        return ReviewQueue(fraction)
+    return ReviewQueue.from_array(items, fraction)
+
+
+def save_review(folder, username, review):
+    # Written atomically, so a crash never leaves a half-written queue
+    with atomic_write(review_file(folder, username), "wb") as f:
+        np.save(f, review.to_array())
+
+
+# Use unittest to test the Leitner boxes, that missed problems come back in the same game, and saving and loading
+class TestReviewQueue(unittest.TestCase):
+    def test_leitner_boxes(self):
+        review = ReviewQueue(clock=None)
+        problem = review_problem(problem_type_names.index("multiplication"), [7, 8])
+        self.assertEqual(problem.string, "7 x 8 = ")
+        self.assertEqual(problem.solution, 56)
+        # Right answers to problems not in review are not tracked
+        review.update(problem, True, now=0.0)
+        self.assertEqual(len(review), 0)
+        review.update(problem, False, now=0.0)
+        self.assertIsNone(review.pop_due(now=29.0))
+        self.assertEqual(review.pop_due(now=30.0), (problem.type, (7, 8, 0, 0)))
+        # Served, so not due again until it is answered
+        self.assertIsNone(review.pop_due(now=30.0))
+        now = 30.0
+        for box in range(1, len(box_intervals)):
+            review.update(problem, True, now)
+            self.assertEqual(review.items[(problem.type, (7, 8, 0, 0))][0], box)
+            self.assertIsNone(review.pop_due(now + box_intervals[box] - 1))
+            now += box_intervals[box]
+            self.assertIsNotNone(review.pop_due(now))
+        review.update(problem, True, now)
+        self.assertEqual(len(review), 0)
+        self.assertIsNone(review.pop_due(now * 2))
+
+    def test_missed_problems_come_back_in_the_game(self):
+        # The review queue reads the same made-up clock as the session
+        now = 0.0
+        review = ReviewQueue(fraction=0.5, clock=lambda: now)
+        session = GameSession(
+            "tester", time_limit=120, clock=None, seed=32, review=review
+        )
+        session.start(now)
+        missed = session.problem
+        session.submit("", now)
+        served = []
+        while now < 100:
+            now += 2.0
+            served.append(session.problem)
+            session.submit(session.solution_string, now)
+        self.assertIn(missed.string, [problem.string for problem in served])
+        self.assertEqual(review.items[(missed.type, tuple(missed.operands))][0], 1)
+
+    def due_review(self):
+        review = ReviewQueue(clock=lambda: 100.0)
+        review.update(
+            review_problem(problem_type_names.index("multiplication"), [7, 8]),
+            False,
+            now=0.0,
+        )
+        return review
+
+    def test_daily_deck_is_not_reviewed(self):
+        # Everybody gets the same daily challenge, so reviews cannot be mixed into a deck
+        with self.assertRaises(ValueError):
+            GameSession(
+                "tester",
+                clock=None,
+                seed=3,
+                problems=DeckSource(build_deck(3, 10)),
+                review=self.due_review(),
+            )
+
+    def test_expression_games_are_not_reviewed(self):
+        # A template problem would score differently from the expression problems of the game
+        with self.assertRaises(ValueError):
+            GameSession(
+                "tester",
+                clock=None,
+                seed=3,
+                expression_depth=2,
+                review=self.due_review(),
+            )
+
+    def test_save_and_load(self):
+        folder = tempfile.mkdtemp()
+        try:
+            review = ReviewQueue(clock=None)
+            for operands in ([3, 4], [5, 6], [9, 2]):
+                review.update(
+                    review_problem(
+                        problem_type_names.index("multiplication"), operands
+                    ),
+                    False,
+                    now=operands[0],
+                )
+            save_review(folder, "tester", review)
+            self.assertEqual(review_dtype.itemsize, 14)
+            loaded = load_review(folder, "tester")
+            self.assertEqual(loaded.items, review.items)
+            self.assertEqual(
+                loaded.pop_due(now=40),
+                (problem_type_names.index("multiplication"), (3, 4, 0, 0)),
+            )
+            self.assertEqual(len(load_review(folder, "nobody")), 0)
+        finally:
+            shutil.rmtree(folder)
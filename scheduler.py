@@ -0,0 +1,182 @@
+import json
+import math
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from files import atomic_write
+from problems import problem_type_names
+
+# Adaptive difficulty: instead of picking every problem type equally often, keep track of how each user does on each type and serve more of the types that are at the right difficulty for them.
+# For every (user, problem type) we keep an exponentially weighted accuracy and a running estimate of the median response time. A type's weight is highest when its accuracy is close to target_accuracy, so problems the player has mastered (and ones that are far too hard) come up less often. Among types of similar accuracy, slower ones get more weight since there is more to gain there.
+# Types are drawn with Walker's alias method, so each draw is O(1) whatever the number of types. The statistics are saved as data/<username>.stats.json next to the score history, keyed by problem type name.
+
+default_target_accuracy = 0.85
+
+
+class AliasTable:
+    # Walker's alias method: after O(n) setup, every draw from the weighted distribution is one random index and one comparison
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        scaled = weights * n / weights.sum()
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1]
+        large = [i for i in range(n) if scaled[i] >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+
+    def sample(self, rng, n):
+        i = rng.integers(0, len(self.prob), size=n)
+        return np.where(rng.random(n) < self.prob[i], i, self.alias[i])
+
+
+class TypeStats:
+    # alpha is how much each new answer moves the accuracy and median estimates
+    def __init__(self, target_accuracy=default_target_accuracy, alpha=0.1):
+        n_types = len(problem_type_names)
+        self.target_accuracy = target_accuracy
+        self.alpha = alpha
+        # Unseen types start at the target accuracy, so they get the highest weight until we know better
+        self.accuracy = np.full(n_types, target_accuracy)
+        self.median_latency = np.full(n_types, np.nan)
+        self.answers = np.zeros(n_types, dtype=np.int64)
+        self.table = None
+
+    def update(self, problem_type, correct, latency):
+        # Update a type's statistics with one answer, latency is in seconds
+        self.accuracy[problem_type] += self.alpha * (
+            correct - self.accuracy[problem_type]
+        )
+        median = self.median_latency[problem_type]
+        if math.isnan(median):
+            self.median_latency[problem_type] = latency
+        else:
+            # Move the median estimate a small step towards the new answer, a step proportional to the estimate keeps it scale-free
+            step = self.alpha * median
+            self.median_latency[problem_type] += step if latency > median else -step
+        self.answers[problem_type] += 1
+        self.table = None
+
+    def weights(self):
+        # Highest weight at the target accuracy, falling off as accuracy moves away from it, never quite zero so every type still comes up now and then
+        closeness = np.exp(-(((self.accuracy - self.target_accuracy) / 0.15) ** 2))
+        # Types without any answers yet count as average speed
+        seen = self.answers > 0
+        average = self.median_latency[seen].mean() if seen.any() else 1.0
+        latency = np.where(seen, self.median_latency, average)
+        slowness = np.clip(latency / average, 0.5, 2.0)
+        return 0.02 + closeness * slowness
+
+    def sample(self, rng, n):
+        # Draw n problem types, rebuilding the alias table only after the statistics changed
+        if self.table is None:
+            self.table = AliasTable(self.weights())
+        return self.table.sample(rng, n)
+
+    def to_dict(self):
+        return {
+            "target_accuracy": self.target_accuracy,
+            "alpha": self.alpha,
+            "types": {
+                name: {
+                    "accuracy": float(self.accuracy[i]),
+                    "median_latency": (
+                        None
+                        if math.isnan(self.median_latency[i])
+                        else float(self.median_latency[i])
+                    ),
+                    "answers": int(self.answers[i]),
+                }
+                for i, name in enumerate(problem_type_names)
+                if self.answers[i]
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data["target_accuracy"], data["alpha"])
+        for name, values in data["types"].items():
+            if name not in problem_type_names:
+                continue  # Problem type that no longer exists
+            i = problem_type_names.index(name)
+            stats.accuracy[i] = values["accuracy"]
+            stats.median_latency[i] = (
+                np.nan if values["median_latency"] is None else values["median_latency"]
+            )
+            stats.answers[i] = values["answers"]
+        return stats
+
+
+def stats_file(folder, username):
+    return os.path.join(folder, f"{username}.stats.json")
+
+
+def load_stats(folder, username, target_accuracy=default_target_accuracy):
+    # The user's saved statistics, or fresh ones for a new user
+    # A file that cannot be read raises ValueError, rather than being taken for a new user and overwritten with fresh statistics at the end of the game
+    path = stats_file(folder, username)
+    try:
+        with open(path) as f:
+            stats = TypeStats.from_dict(json.load(f))
+    except FileNotFoundError:
+        return TypeStats(target_accuracy)
+    except (ValueError, KeyError) as error:
+        raise ValueError(
+            f"Cannot read the statistics in {path}, move it away to start over: {error!r}"
+        ) from error
+    stats.target_accuracy = target_accuracy
+    return stats
+
+
+def save_stats(folder, username, stats):
+    # Written atomically, so a crash never leaves half-written statistics
+    with atomic_write(stats_file(folder, username)) as f:
+        json.dump(stats.to_dict(), f)
+
+
+# Use unittest to test the alias method and that the scheduler moves towards the types at the target accuracy
+class TestScheduler(unittest.TestCase):
+    def test_alias_table_matches_weights(self):
+        weights = np.array([1, 2, 3, 4, 0.5])
+        draws = AliasTable(weights).sample(np.random.default_rng(32), 200000)
+        frequencies = np.bincount(draws, minlength=len(weights)) / len(draws)
+        np.testing.assert_allclose(frequencies, weights / weights.sum(), atol=0.005)
+
+    def test_mastered_types_come_up_less(self):
+        stats = TypeStats(target_accuracy=0.8)
+        for _ in range(50):
+            stats.update(0, True, 1.0)  # Addition is mastered
+            stats.update(1, True, 1.0)
+            stats.update(1, False, 1.0)  # Subtraction is right only half the time
+            stats.update(2, _ % 5 != 0, 1.0)  # Multiplication is right 80% of the time
+        draws = np.bincount(
+            stats.sample(np.random.default_rng(32), 100000), minlength=3
+        )
+        self.assertGreater(draws[2], draws[1])
+        self.assertGreater(draws[2], draws[0])
+
+    def test_save_and_load(self):
+        folder = tempfile.mkdtemp()
+        try:
+            stats = TypeStats()
+            stats.update(3, False, 2.5)
+            save_stats(folder, "tester", stats)
+            loaded = load_stats(folder, "tester")
+            np.testing.assert_array_equal(loaded.accuracy, stats.accuracy)
+            np.testing.assert_array_equal(loaded.answers, stats.answers)
+            self.assertEqual(loaded.median_latency[3], 2.5)
+            self.assertEqual(load_stats(folder, "nobody").answers.sum(), 0)
+            # A corrupt file is not mistaken for a new user
+            with open(stats_file(folder, "tester"), "w") as f:
+                f.write('{"accuracy": [')
+            with self.assertRaises(ValueError):
+                load_stats(folder, "tester")
+        finally:
+            shutil.rmtree(folder)
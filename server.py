@@ -0,0 +1,273 @@
+import argparse
+import asyncio
+import contextlib
+from datetime import datetime
+import io
+import re
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from engine import GameSession
+from leaderboard import timestamp_format
+from storage import open_score_store
+
+# Headless game server: many timed games at once in one asyncio process, played over a newline-delimited text protocol on TCP or a Unix socket.
+# A client sends its username as the first line. The server then sends one line per problem, "<verdict> <score> <seconds left> <problem>", where verdict is START for the first problem and RIGHT or WRONG for the answer just given. Every line the client sends after its username is an answer. When time is up the server sends "OVER <score> <answered> <correct>" and closes the connection.
+# Each connection is a GameSession with the same rules and scoring as the Tk game, timed with the event loop's clock, so a game ends at its deadline even if the player stops answering.
+# Finished games are not written one by one: a background task saves everything that finished in the last flush_interval seconds with one append_many, in a worker thread so the event loop never waits on the disk.
+
+# Usernames end up in file names with the CSV backend, so only allow plain ones
+username_pattern = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]{0,31}")
+
+
+def raise_open_file_limit():
+    # Every connection is a file descriptor, allow as many as the system lets us
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def exchange(reader, writer, data):
+    # Send data to the client and return the next line it sends
+    writer.write(data)
+    await writer.drain()
+    return await reader.readline()
+
+
+class GameServer:
+    # Time limit is in seconds like in the Tk game, queue_size is how many problems each session keeps ready
+    # io_timeout is how many seconds a client gets to send its username, and to read the final OVER line, before it is disconnected
+    def __init__(
+        self, store, time_limit=120, flush_interval=1.0, queue_size=16, io_timeout=10.0
+    ):
+        self.store = store
+        self.time_limit = time_limit
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.io_timeout = io_timeout
+        # (username, timestamp, score) of finished games that are not saved yet
+        self.pending = []
+        self.active = 0
+        self.finished = 0
+        self.server = None
+        self.flusher = None
+
+    async def handle(self, reader, writer):
+        self.active += 1
+        try:
+            await self.play(reader, writer)
+        except ConnectionError:
+            pass  # The player went away, an unfinished game is not saved
+        finally:
+            self.active -= 1
+            writer.close()
+
+    async def play(self, reader, writer):
+        # Every wait on the client has a timeout, so a client that stops sending or reading cannot keep its coroutine alive. asyncio.wait_for rather than asyncio.timeout_at keeps this working on Python 3.9 and 3.10
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.io_timeout)
+        except asyncio.TimeoutError:
+            return
+        username = line.decode(errors="replace").strip()
+        if not username_pattern.fullmatch(username):
+            writer.write(b"ERROR invalid username\n")
+            try:
+                await asyncio.wait_for(writer.drain(), self.io_timeout)
+            except asyncio.TimeoutError:
+                pass
+            return
+        session = GameSession(
+            username,
+            time_limit=self.time_limit,
+            clock=asyncio.get_running_loop().time,
+            queue_size=self.queue_size,
+        )
+        session.start()
+        verdict = "START"
+        while True:
+            problem = f"{verdict} {session.score} {session.time_left():.2f} {session.problem_string}\n"
+            try:
+                # Sending the problem and waiting for the answer both have to finish before the end of the game
+                line = await asyncio.wait_for(
+                    exchange(reader, writer, problem.encode()), session.time_left()
+                )
+            except asyncio.TimeoutError:
+                break
+            if not line:
+                return  # Disconnected before the end of the game
+            correct = session.submit(line.decode(errors="replace").strip())
+            if not session.tick():
+                break
+            verdict = "RIGHT" if correct else "WRONG"
+        # The game is over whether or not the client reads the result, so it is saved first
+        result = session.result()
+        self.pending.append(
+            (username, datetime.now().strftime(timestamp_format), result.score)
+        )
+        self.finished += 1
+        writer.write(
+            f"OVER {result.score} {result.answered} {result.correct}\n".encode()
+        )
+        try:
+            await asyncio.wait_for(writer.drain(), self.io_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def save_pending(self):
+        # Save every finished game so far in one batch. If that fails the batch goes back in front of the games that finished meanwhile, to be saved with them next time
+        rows, self.pending = self.pending, []
+        if rows:
+            try:
+                await asyncio.to_thread(self.store.append_many, rows)
+            except Exception:
+                self.pending[:0] = rows
+                raise
+
+    async def flush_scores(self):
+        # Keeps running when a save fails (a full disk, or a database locked for too long), so the games are saved once the store works again
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.save_pending()
+            except Exception as error:
+                print(
+                    f"could not save {len(self.pending)} scores, retrying: {error!r}",
+                    file=sys.stderr,
+                    flush=True,
+                )
+
+    async def start(self, host="127.0.0.1", port=0, unix_path=None):
+        # Start listening on host:port, or on a Unix socket at unix_path. Returns the address actually listened on
+        if unix_path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, unix_path)
+        else:
+            self.server = await asyncio.start_server(
+                self.handle, host, port, backlog=4096
+            )
+        self.flusher = asyncio.create_task(self.flush_scores())
+        # Sessions import the problem generator (and numpy) on their second problem, do that now rather than while the first players wait
+        GameSession("warmup").make_queue()
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        # Stop accepting players and save the games that already finished
+        self.server.close()
+        await self.server.wait_closed()
+        self.flusher.cancel()
+        await self.save_pending()
+
+
+async def serve(args):
+    raise_open_file_limit()
+    store = open_score_store(args.backend, args.folder)
+    server = GameServer(store, args.time_limit, args.flush_interval)
+    address = await server.start(args.host, args.port, args.unix)
+    if not isinstance(address, str):
+        address = f"{address[0]}:{address[1]}"
+    # loadgen.py reads this line to find out where the server is listening
+    print(f"listening on {address}", flush=True)
+    start_cpu = time.process_time()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+    await stop.wait()
+    await server.close()
+    store.close()
+    cpu = time.process_time() - start_cpu
+    print(f"served {server.finished} games in {cpu:.3f} cpu seconds", flush=True)
+
+
+# Use unittest to test a whole game over a real socket, and that finished games are saved
+class TestGameServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = open_score_store("sqlite", self.folder)
+        self.server = GameServer(self.store, time_limit=0.5, flush_interval=0.05)
+        self.address = await self.server.start()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+        self.store.close()
+        shutil.rmtree(self.folder)
+
+    async def test_play_a_game(self):
+        reader, writer = await asyncio.open_connection(*self.address)
+        writer.write(b"tester\n")
+        verdict, score, time_left, problem = (
+            (await reader.readline()).decode().split(" ", 3)
+        )
+        self.assertEqual((verdict, score), ("START", "0"))
+        self.assertLessEqual(float(time_left), 0.5)
+        expression = problem.strip().rstrip("= ").replace("x", "*").replace("^", "**")
+        writer.write(f"{eval(expression.replace('/', '//'))}\n".encode())
+        verdict, score, _, _ = (await reader.readline()).decode().split(" ", 3)
+        self.assertEqual(verdict, "RIGHT")
+        self.assertGreater(int(score), 0)
+        writer.write(b"not a number\n")
+        verdict, wrong_score, _, _ = (await reader.readline()).decode().split(" ", 3)
+        self.assertEqual((verdict, wrong_score), ("WRONG", score))
+        # Stop answering, the game still ends on time
+        self.assertEqual(
+            (await reader.readline()).decode().split(), ["OVER", score, "2", "1"]
+        )
+        self.assertEqual(await reader.readline(), b"")
+        writer.close()
+        await asyncio.sleep(0.1)
+        self.assertEqual([s for _, s in self.store.recent("tester")], [int(score)])
+
+    async def test_failed_save_is_retried(self):
+        append_many = self.store.append_many
+        failures = []
+
+        def flaky_append_many(rows):
+            if not failures:
+                failures.append(rows)
+                raise sqlite3.OperationalError("database is locked")
+            append_many(rows)
+
+        self.store.append_many = flaky_append_many
+        self.server.pending.append(("tester", "2024-04-08 12:00:00", 7))
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            await asyncio.sleep(0.3)
+        self.assertEqual(len(failures), 1)
+        self.assertIn("database is locked", stderr.getvalue())
+        self.assertEqual(self.server.pending, [])
+        self.assertEqual([s for _, s in self.store.recent("tester")], [7])
+
+    async def test_silent_client_is_disconnected(self):
+        self.server.io_timeout = 0.1
+        reader, writer = await asyncio.open_connection(*self.address)
+        self.assertEqual(await asyncio.wait_for(reader.read(), 1.0), b"")
+        self.assertEqual(self.server.active, 0)
+        writer.close()
+
+    async def test_invalid_username(self):
+        reader, writer = await asyncio.open_connection(*self.address)
+        writer.write(b"../etc\n")
+        self.assertEqual(await reader.readline(), b"ERROR invalid username\n")
+        writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Host many UltraMac games at once")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777, help="0 picks a free port")
+    parser.add_argument("--unix", help="listen on a Unix socket at this path instead")
+    parser.add_argument(
+        "--time-limit", type=float, default=120, help="seconds per game"
+    )
+    parser.add_argument("--folder", default="./data", help="where to save scores")
+    parser.add_argument("--backend", choices=("csv", "sqlite"), default="sqlite")
+    parser.add_argument(
+        "--flush-interval", type=float, default=1.0, help="seconds between score saves"
+    )
+    asyncio.run(serve(parser.parse_args()))
@@ -0,0 +1,530 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import argparse
+import csv
+import glob
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not on Windows, where the lock only keeps apart the threads of one process
+from files import atomic_write
+from leaderboard import ScoreSummary, window_start
+
+# Score storage for UltraMac. Every game adds one row (Username, DateTime, Score) to the player's history.
+# CsvScoreStore keeps the same data/<username>.csv files as before, so existing score histories are picked up as they are, but it only ever appends the new row instead of reading the whole file and writing it back out. Each append is fsynced, so a finished game is on disk before the scores are shown.
+# If the process dies in the middle of an append, the file can end with a torn partial row. That row is skipped when reading, and a compaction rewrites the file without it in the background, writing to a temporary file first and renaming it over the original so the history is never left half written.
+# SqliteScoreStore is the optional alternative for many users and many game processes: one database file shared by every user, in WAL mode so readers never block the writer, with indexes for per-user and global leaderboards. import_csv_folder loads the existing CSV histories into it.
+# Next to each history, data/<username>.summary.json holds the user's recent and top scores (see leaderboard.py), so the end-of-game screen does not need the full history. The summary remembers the size of the CSV file it was built from, and is rebuilt from the history whenever the sizes do not match (for example the first time an old history is used, or after a crash between the two writes).
+
+score_columns = ["Username", "DateTime", "Score"]
+
+
+class ScoreStore(ABC):
+    # Interface shared by the score storage backends
+    @abstractmethod
+    def append(self, username, timestamp, score):
+        pass
+
+    def append_many(self, rows):
+        # Save many (username, timestamp, score) rows at once
+        for username, timestamp, score in rows:
+            self.append(username, timestamp, score)
+
+    @abstractmethod
+    def history(self, username):
+        # All of a user's scores as a DataFrame with score_columns
+        pass
+
+    def recent(self, username, n=5):
+        # The user's n most recent scores, most recent first, as (timestamp, score) pairs
+        scores = self.history(username).sort_values(by="DateTime", ascending=False)
+        return list(zip(scores["DateTime"], scores["Score"]))[:n]
+
+    def top(self, username, n=5, window="all"):
+        # The user's n highest scores within the window ("today", "week" or "all"), highest first, as (timestamp, score) pairs
+        summary = ScoreSummary.from_history(self.history(username), k=n)
+        return summary.top_scores(window, n)
+
+    def close(self):
+        pass
+
+
+class CsvScoreStore(ScoreStore):
+    # top_k and recent_count set how many top and recent scores the per-user summaries keep
+    def __init__(self, folder, top_k=5, recent_count=5):
+        self.folder = folder
+        self.top_k = top_k
+        self.recent_count = recent_count
+        self.lock = threading.Lock()
+        self.compactions = []
+        self.summaries = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def score_file(self, username):
+        return os.path.join(self.folder, f"{username}.csv")
+
+    def summary_file(self, username):
+        return os.path.join(self.folder, f"{username}.summary.json")
+
+    @contextmanager
+    def locked(self, username):
+        # Hold the lock for writing a user's files, against other threads and, with an flock on data/<username>.lock, other game processes
+        # The lock has its own file because compaction replaces the score file, and a lock on the replaced file would no longer keep anyone out
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.folder, f"{username}.lock"), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def append(self, username, timestamp, score):
+        self._append_rows(username, [(timestamp, score)])
+
+    def append_many(self, rows):
+        # Group the rows by user, so each user's file gets one write and one fsync per batch
+        by_user = {}
+        for username, timestamp, score in rows:
+            by_user.setdefault(username, []).append((timestamp, score))
+        for username, user_rows in by_user.items():
+            self._append_rows(username, user_rows)
+
+    def _append_rows(self, username, rows):
+        # Append a user's rows with a single write, then fsync it. Creates the file with a header for new users
+        score_file = self.score_file(username)
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator="\n")
+        for timestamp, score in rows:
+            writer.writerow([username, timestamp, score])
+        data = text.getvalue().encode()
+        torn = False
+        with self.locked(username):
+            with open(score_file, "a+b") as f:
+                if f.tell() == 0:
+                    f.write(",".join(score_columns).encode() + b"\n")
+                else:
+                    f.seek(-1, os.SEEK_END)
+                    # A file that does not end with a newline has a torn last row, so start our rows on a fresh line
+                    torn = f.read(1) != b"\n"
+                    if torn:
+                        f.write(b"\n")
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            summary = self._load_summary(username, size - len(data))
+            for timestamp, score in rows:
+                summary.add(timestamp, score)
+            self._save_summary(username, summary, size)
+        if torn:
+            self.compact_in_background(username)
+
+    def history(self, username):
+        try:
+            scores = pd.read_csv(self.score_file(username), on_bad_lines="skip")
+        except FileNotFoundError:
+            return pd.DataFrame(columns=score_columns)
+        return _clean_scores(scores)
+
+    def recent(self, username, n=5):
+        with self.lock:
+            summary = self._load_summary(username)
+        return summary.recent_scores(n)
+
+    def top(self, username, n=5, window="all"):
+        with self.lock:
+            summary = self._load_summary(username)
+        return summary.top_scores(window, n)
+
+    def _load_summary(self, username, size=None):
+        # The user's summary, as of a CSV file of the given size (the current size by default). Must be called with the lock held
+        if size is None:
+            try:
+                size = os.path.getsize(self.score_file(username))
+            except FileNotFoundError:
+                size = 0
+        cached = self.summaries.get(username)
+        if cached is None:
+            try:
+                with open(self.summary_file(username)) as f:
+                    data = json.load(f)
+                cached = (data["csv_size"], ScoreSummary.from_dict(data["summary"]))
+            except (FileNotFoundError, ValueError, KeyError):
+                cached = (None, None)
+        csv_size, summary = cached
+        if (
+            csv_size != size
+            or summary.k < self.top_k
+            or summary.recent.maxlen < self.recent_count
+        ):
+            summary = ScoreSummary.from_history(
+                self._history(username, size), self.top_k, self.recent_count
+            )
+        self.summaries[username] = (size, summary)
+        return summary
+
+    def _history(self, username, size):
+        # Scores from the first size bytes of the user's CSV file, which leaves out a row that is being appended
+        if size == 0:
+            return pd.DataFrame(columns=score_columns)
+        with open(self.score_file(username), "rb") as f:
+            data = f.read(size)
+        return _clean_scores(pd.read_csv(io.BytesIO(data), on_bad_lines="skip"))
+
+    def _save_summary(self, username, summary, size):
+        # Atomically replace the summary file, it can always be rebuilt from the history so it is not fsynced
+        self.summaries[username] = (size, summary)
+        with atomic_write(self.summary_file(username)) as f:
+            json.dump({"csv_size": size, "summary": summary.to_dict()}, f)
+
+    def compact(self, username):
+        # Rewrite the user's file without torn rows: write a temporary file, fsync it, then atomically rename it over the original
+        score_file = self.score_file(username)
+        with self.locked(username):
+            summary = self._load_summary(username)
+            with open(score_file, newline="") as f:
+                rows = [row for row in csv.reader(f) if _is_valid_row(row)]
+            with atomic_write(score_file, fsync=True, newline="") as f:
+                writer = csv.writer(f, lineterminator="\n")
+                writer.writerow(score_columns)
+                writer.writerows(rows)
+            # Only torn rows were dropped, so the summary is unchanged and just needs the new file size
+            self._save_summary(username, summary, os.path.getsize(score_file))
+
+    def compact_in_background(self, username):
+        thread = threading.Thread(target=self.compact, args=(username,), daemon=True)
+        thread.start()
+        self.compactions.append(thread)
+
+    def close(self):
+        # Wait for any background compactions to finish
+        for thread in self.compactions:
+            thread.join()
+        self.compactions = []
+
+
+class SqliteScoreStore(ScoreStore):
+    def __init__(self, database):
+        self.database = database
+        self.lock = threading.Lock()
+        # timeout makes writers in other processes wait their turn instead of failing with "database is locked"
+        self.connection = sqlite3.connect(database, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS scores (
+                    id INTEGER PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    datetime TEXT NOT NULL,
+                    score INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS scores_username_datetime ON scores (username, datetime);
+                CREATE INDEX IF NOT EXISTS scores_username_score ON scores (username, score, datetime);
+                CREATE INDEX IF NOT EXISTS scores_score ON scores (score, datetime);
+                CREATE TABLE IF NOT EXISTS imported_files (path TEXT PRIMARY KEY, rows INTEGER NOT NULL);
+                """)
+
+    def append(self, username, timestamp, score):
+        self.append_many([(username, timestamp, score)])
+
+    def append_many(self, rows):
+        # All of the rows go in one transaction, so a batch costs a single commit
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO scores (username, datetime, score) VALUES (?, ?, ?)", rows
+            )
+
+    def history(self, username):
+        with self.lock:
+            return pd.read_sql_query(
+                "SELECT username AS Username, datetime AS DateTime, score AS Score"
+                " FROM scores WHERE username = ? ORDER BY datetime",
+                self.connection,
+                params=(username,),
+            )
+
+    def recent(self, username, n=5):
+        return self._query(
+            "SELECT datetime, score FROM scores WHERE username = ?"
+            " ORDER BY datetime DESC LIMIT ?",
+            (username, n),
+        )
+
+    def top(self, username, n=5, window="all"):
+        # All time reads the (username, score) index in order, shorter windows scan the user's (username, datetime) range and sort it
+        if window == "all":
+            return self._query(
+                "SELECT datetime, score FROM scores WHERE username = ?"
+                " ORDER BY score DESC, datetime DESC LIMIT ?",
+                (username, n),
+            )
+        return self._query(
+            "SELECT datetime, score FROM scores INDEXED BY scores_username_datetime"
+            " WHERE username = ? AND datetime >= ?"
+            " ORDER BY score DESC, datetime DESC LIMIT ?",
+            (username, window_start(window), n),
+        )
+
+    def global_top(self, n=10, window="all"):
+        # The n highest scores of all users within the window, as (username, timestamp, score) rows
+        if window == "all":
+            return self._query(
+                "SELECT username, datetime, score FROM scores"
+                " ORDER BY score DESC, datetime DESC LIMIT ?",
+                (n,),
+            )
+        return self._query(
+            "SELECT username, datetime, score FROM scores WHERE datetime >= ?"
+            " ORDER BY score DESC, datetime DESC LIMIT ?",
+            (window_start(window), n),
+        )
+
+    def _query(self, sql, params):
+        with self.lock:
+            return [tuple(row) for row in self.connection.execute(sql, params)]
+
+    def import_csv_folder(self, folder, batch_size=10000):
+        # One-shot import of the data/<username>.csv histories, in batches of batch_size rows. Files that were already imported are skipped, so running it again is safe
+        # A file's rows and its imported_files marker go in one transaction, so an import that is stopped halfway through a file leaves none of its rows behind
+        insert = "INSERT INTO scores (username, datetime, score) VALUES (?, ?, ?)"
+        imported = 0
+        for score_file in sorted(glob.glob(os.path.join(folder, "*.csv"))):
+            path = os.path.abspath(score_file)
+            with open(score_file, newline="") as f, self.lock, self.connection:
+                done = self.connection.execute(
+                    "SELECT 1 FROM imported_files WHERE path = ?", (path,)
+                ).fetchone()
+                reader = csv.reader(f)
+                if done or next(reader, None) != score_columns:
+                    continue  # Already imported, or not a score history
+                rows = 0
+                batch = []
+                for row in reader:
+                    if _is_valid_row(row):
+                        batch.append((row[0], row[1], int(row[2])))
+                    if len(batch) == batch_size:
+                        self.connection.executemany(insert, batch)
+                        rows += len(batch)
+                        batch = []
+                self.connection.executemany(insert, batch)
+                rows += len(batch)
+                self.connection.execute(
+                    "INSERT INTO imported_files (path, rows) VALUES (?, ?)",
+                    (path, rows),
+                )
+            imported += rows
+        return imported
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def open_score_store(backend, folder):
+    # Open the "csv" (one file per user) or "sqlite" (one database for everyone) score store, both kept in folder
+    if backend == "csv":
+        return CsvScoreStore(folder)
+    if backend == "sqlite":
+        os.makedirs(folder, exist_ok=True)
+        return SqliteScoreStore(os.path.join(folder, "scores.db"))
+    raise ValueError(f"Invalid score backend: {backend}")
+
+
+def _clean_scores(scores):
+    # Torn rows come back with a missing or partial score, drop them
+    scores["Score"] = pd.to_numeric(scores["Score"], errors="coerce")
+    scores = scores.dropna(subset=["Score"])
+    return scores.astype({"Score": "int64"}).reset_index(drop=True)
+
+
+def _is_valid_row(row):
+    return len(row) == len(score_columns) and row[2].lstrip("-").isdigit()
+
+
+# Use unittest to test the CSV score store, specifically appending to existing histories and recovering from a torn row
+class TestCsvScoreStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = CsvScoreStore(self.folder)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.folder)
+
+    def test_append_new_and_existing_user(self):
+        self.store.append("tester", "2024-04-08 20:50:49", 2)
+        with open(self.store.score_file("old"), "w") as f:
+            f.write("Username,DateTime,Score\nold,2024-03-23 20:52:15,1\n")
+        self.store.append("old", "2024-04-08 20:51:13", 5)
+        self.assertEqual(self.store.history("tester")["Score"].tolist(), [2])
+        self.assertEqual(self.store.history("old")["Score"].tolist(), [1, 5])
+        self.assertTrue(self.store.history("nobody").empty)
+
+    def test_append_many(self):
+        self.store.append("tester", "2024-04-08 20:50:49", 2)
+        self.store.append_many(
+            [
+                ("tester", "2024-04-09 20:50:49", 7),
+                ("other", "2024-04-09 20:51:00", 4),
+                ("tester", "2024-04-10 20:50:49", 5),
+            ]
+        )
+        self.assertEqual(self.store.history("tester")["Score"].tolist(), [2, 7, 5])
+        self.assertEqual([s for _, s in self.store.top("tester")], [7, 5, 2])
+        self.assertEqual(self.store.recent("other"), [("2024-04-09 20:51:00", 4)])
+
+    def test_summary_matches_history(self):
+        for day, score in enumerate([3, 8, 1, 6, 9, 2, 7]):
+            self.store.append("tester", f"2024-04-0{day + 1} 20:50:49", score)
+        # A fresh store reads the persisted summary instead of the history
+        store = CsvScoreStore(self.folder)
+        self.assertEqual([s for _, s in store.recent("tester")], [7, 2, 9, 6, 1])
+        self.assertEqual([s for _, s in store.top("tester")], [9, 8, 7, 6, 3])
+        self.assertEqual(
+            store.summaries["tester"][0], os.path.getsize(store.score_file("tester"))
+        )
+        # Appending behind the summary's back makes it rebuild from the history
+        with open(store.score_file("tester"), "a") as f:
+            f.write("tester,2024-04-08 20:50:49,10\n")
+        self.assertEqual([s for _, s in store.top("tester", n=2)], [10, 9])
+
+    def test_torn_row_is_skipped_and_compacted(self):
+        with open(self.store.score_file("tester"), "w") as f:
+            f.write(
+                "Username,DateTime,Score\ntester,2024-03-23 20:52:15,1\ntester,2024-03"
+            )
+        self.store.append("tester", "2024-04-08 20:51:13", 3)
+        self.assertEqual(self.store.history("tester")["Score"].tolist(), [1, 3])
+        self.store.close()
+        with open(self.store.score_file("tester")) as f:
+            self.assertEqual(
+                f.read(),
+                "Username,DateTime,Score\ntester,2024-03-23 20:52:15,1\ntester,2024-04-08 20:51:13,3\n",
+            )
+
+    def test_compaction_by_another_store_loses_nothing(self):
+        # Two stores on one folder stand for two game processes, one appending while the other compacts
+        other = CsvScoreStore(self.folder)
+        self.store.append("tester", "2024-04-08 20:51:13", 0)
+        done = threading.Event()
+
+        def compact():
+            while not done.is_set():
+                other.compact("tester")
+
+        thread = threading.Thread(target=compact)
+        thread.start()
+        for i in range(1, 200):
+            self.store.append("tester", "2024-04-08 20:51:13", i)
+        done.set()
+        thread.join()
+        self.assertEqual(
+            self.store.history("tester")["Score"].tolist(), list(range(200))
+        )
+
+    def test_incomplete_backend_fails_when_created(self):
+        class AppendOnly(ScoreStore):
+            def append(self, username, timestamp, score):
+                pass
+
+        with self.assertRaises(TypeError):
+            AppendOnly()
+
+
+# Use unittest to test the SQLite score store, including importing CSV histories and several writers sharing one database
+class TestSqliteScoreStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = open_score_store("sqlite", self.folder)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.folder)
+
+    def test_recent_and_top_scores(self):
+        self.store.append_many(
+            [
+                ("tester", f"2024-04-0{day + 1} 20:50:49", score)
+                for day, score in enumerate([3, 8, 1, 6, 9, 2, 7])
+            ]
+        )
+        self.store.append("other", "2024-04-08 20:50:49", 20)
+        self.assertEqual([s for _, s in self.store.recent("tester")], [7, 2, 9, 6, 1])
+        self.assertEqual([s for _, s in self.store.top("tester")], [9, 8, 7, 6, 3])
+        self.assertEqual(
+            self.store.global_top(2),
+            [
+                ("other", "2024-04-08 20:50:49", 20),
+                ("tester", "2024-04-05 20:50:49", 9),
+            ],
+        )
+        self.assertEqual(
+            self.store.history("tester")["Score"].tolist(), [3, 8, 1, 6, 9, 2, 7]
+        )
+
+    def test_import_csv_folder(self):
+        with open(os.path.join(self.folder, "old.csv"), "w") as f:
+            f.write(
+                "Username,DateTime,Score\nold,2024-03-23 20:52:15,1\nold,2024-03-23 20:53:12,4\n"
+            )
+        self.assertEqual(self.store.import_csv_folder(self.folder, batch_size=1), 2)
+        self.assertEqual(self.store.import_csv_folder(self.folder), 0)
+        self.assertEqual([s for _, s in self.store.top("old")], [4, 1])
+
+    def test_interrupted_import_leaves_no_rows(self):
+        with open(os.path.join(self.folder, "torn.csv"), "w") as f:
+            f.write(
+                "Username,DateTime,Score\ntorn,2024-03-23 20:52:15,1\ntorn,2024-03-23 20:53:12,4\n"
+            )
+        # Fail on the marker, after the rows have been inserted
+        self.store.connection.execute(
+            "CREATE TRIGGER fail BEFORE INSERT ON imported_files BEGIN SELECT RAISE(ABORT, 'killed'); END"
+        )
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.store.import_csv_folder(self.folder, batch_size=1)
+        self.store.connection.execute("DROP TRIGGER fail")
+        self.assertEqual(len(self.store.history("torn")), 0)
+        self.assertEqual(self.store.import_csv_folder(self.folder), 2)
+        self.assertEqual(len(self.store.history("torn")), 2)
+
+    def test_concurrent_writers(self):
+        def play(i):
+            store = open_score_store("sqlite", self.folder)
+            for game in range(50):
+                store.append(f"player{i}", f"2024-04-08 20:{game:02d}:00", game)
+            store.close()
+
+        threads = [threading.Thread(target=play, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.store.global_top(1000)), 200)
+
+
+if __name__ == "__main__":
+    # Import the existing CSV score histories into the SQLite score database
+    parser = argparse.ArgumentParser(
+        description="Import UltraMac CSV score histories into SQLite"
+    )
+    parser.add_argument("folder", nargs="?", default="./data")
+    args = parser.parse_args()
+    store = open_score_store("sqlite", args.folder)
+    print(
+        f"Imported {store.import_csv_folder(args.folder)} scores into {store.database}"
+    )
+    store.close()
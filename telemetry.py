@@ -0,0 +1,157 @@
+import glob
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+from engine import GameSession
+from files import atomic_write
+from problems import max_operands
+
+# Per-answer telemetry: for every answer we keep the problem type and operands, whether the answer was right, and how long the player took in milliseconds (measured with the session's monotonic clock).
+# Answers are only appended to a Python list during the game, which costs well under a microsecond, and are written out all at once when the game ends.
+# Each game is flushed as one .npy chunk of a numpy structured array under <folder>/<username>/, so writing never touches earlier games and load_answers can concatenate any number of chunks for analysis.
+
+answer_dtype = np.dtype(
+    [
+        # The session's seed, which is 128 bits (see engine.py), split in two
+        ("seed_low", np.uint64),
+        ("seed_high", np.uint64),
+        ("time", np.float32),  # Seconds since the start of the game
+        ("type", np.uint8),  # Index into problem_templates, or expression_type
+        ("operands", np.int32, (max_operands,)),
+        ("solution", np.int32),
+        ("correct", np.bool_),
+        ("latency_ms", np.float32),
+    ]
+)
+
+
+# Type recorded for expression-tree problems, which are not one of the problem templates
+expression_type = 255
+
+
+class AnswerLog:
+    def __init__(self, folder, username, seed=0):
+        self.folder = folder
+        self.username = username
+        self.seed = seed if seed is not None else 0
+        self.start = 0.0
+        self.records = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def record(self, now, problem, correct, latency):
+        # Called once per answer, latency is in seconds
+        self.records.append((now, problem, correct, latency))
+
+    def to_array(self):
+        answers = np.empty(len(self.records), dtype=answer_dtype)
+        if not self.records:
+            return answers
+        now, problems, correct, latency = zip(*self.records)
+        answers["seed_low"] = self.seed % 2**64
+        answers["seed_high"] = self.seed // 2**64 % 2**64
+        answers["time"] = np.subtract(now, self.start)
+        answers["type"] = [
+            expression_type if problem.type is None else problem.type
+            for problem in problems
+        ]
+        answers["operands"] = [problem.operands for problem in problems]
+        answers["solution"] = [problem.solution for problem in problems]
+        answers["correct"] = correct
+        answers["latency_ms"] = np.multiply(latency, 1000)
+        return answers
+
+    def flush(self):
+        # Write the buffered answers as a new chunk, returns the chunk's path (None if there was nothing to write)
+        if not self.records:
+            return None
+        name = f"{time.time_ns()}-{os.getpid()}.npy"
+        path = os.path.join(self.folder, self.username, name)
+        # Written atomically, so readers never see a half-written chunk
+        with atomic_write(path, "wb") as f:
+            np.save(f, self.to_array())
+        self.records = []
+        return path
+
+
+def answer_seeds(answers):
+    # The full session seed of every answer, as Python ints that GameSession(seed=...) replays
+    return [
+        high << 64 | low
+        for low, high in zip(
+            answers["seed_low"].tolist(), answers["seed_high"].tolist()
+        )
+    ]
+
+
+def _upgrade(chunk):
+    # Chunks written before seeds were split in two kept only the low 64 bits, as "seed"
+    if "seed" not in chunk.dtype.names:
+        return chunk
+    answers = np.zeros(len(chunk), dtype=answer_dtype)
+    for name in chunk.dtype.names:
+        answers["seed_low" if name == "seed" else name] = chunk[name]
+    return answers
+
+
+def load_answers(folder, username="*"):
+    # All of the answers logged for a user (every user by default) as one structured array
+    chunks = [
+        _upgrade(np.load(path, mmap_mode="r"))
+        for path in sorted(glob.glob(os.path.join(folder, username, "*.npy")))
+    ]
+    if not chunks:
+        return np.empty(0, dtype=answer_dtype)
+    return np.concatenate(chunks)
+
+
+# Use unittest to test that logged answers survive a round trip to disk
+class TestAnswerLog(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_flush_and_load(self):
+        log = AnswerLog(self.folder, "tester", seed=3)
+        session = GameSession("tester", clock=None, seed=3, answer_log=log)
+        session.start(10.0)
+        session.submit(str(session.solution), 11.5)
+        session.submit("", 12.0)
+        self.assertIsNone(AnswerLog(self.folder, "other").flush())
+        log.flush()
+        self.assertEqual(len(log), 0)
+        session.submit(str(session.solution), 14.25)
+        log.flush()
+        answers = load_answers(self.folder)
+        self.assertEqual(answers["correct"].tolist(), [True, False, True])
+        np.testing.assert_allclose(answers["latency_ms"], [1500, 500, 2250])
+        np.testing.assert_allclose(answers["time"], [1.5, 2.0, 4.25])
+        self.assertEqual(answer_seeds(answers), [3, 3, 3])
+        self.assertEqual(len(load_answers(self.folder, "nobody")), 0)
+
+    def test_logged_seed_replays_the_game(self):
+        # A session without an explicit seed gets 128 random bits, all of which are logged
+        log = AnswerLog(self.folder, "tester")
+        session = GameSession("tester", clock=None, answer_log=log)
+        log.seed = session.seed
+        session.start(0.0)
+        played = []
+        for now in range(1, 6):
+            played.append(session.problem_string)
+            session.submit("", float(now))
+        log.flush()
+        seed = answer_seeds(load_answers(self.folder))[0]
+        self.assertEqual(seed, session.seed)
+        replay = GameSession("tester", clock=None, seed=seed)
+        replay.start(0.0)
+        replayed = []
+        for now in range(1, 6):
+            replayed.append(replay.problem_string)
+            replay.submit("", float(now))
+        self.assertEqual(replayed, played)
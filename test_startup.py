@@ -0,0 +1,223 @@
+import random
+import unittest
+import numpy as np
+from bench import (
+    bench_keystrokes,
+    deferred_modules,
+    import_times,
+    keystroke_budget,
+    startup_budget,
+)
+from engine import GameSession, simulate_session, simulate_sessions
+from problem_index import ProblemIndex, build_index
+from problem_table import draw_problem, problem_templates
+from problems import solve_batch
+from review import ReviewQueue
+from scheduler import TypeStats
+
+# Tests for the modules that run before the first problem is on screen (UltraMac.py, engine.py and problem_table.py). They live here rather than at the bottom of those modules so that starting the game never imports unittest.
+
+
+# Use unittest to test the game rules without opening any Tkinter window, using a fake clock
+class TestGameSession(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.session = GameSession(
+            "tester",
+            time_limit=20,
+            clock=lambda: self.now,
+            rng=np.random.default_rng(32),
+        )
+        self.session.start()
+
+    def test_correct_and_wrong_answers(self):
+        problem_score = self.session.problem_score
+        self.assertTrue(self.session.submit(str(self.session.solution)))
+        self.assertEqual(self.session.score, problem_score)
+        self.assertFalse(self.session.submit("not a number"))
+        self.assertEqual(self.session.score, problem_score)
+        self.assertEqual(self.session.result().answered, 2)
+        self.assertEqual(self.session.result().correct, 1)
+
+    def test_check_typed(self):
+        solution = self.session.solution_string
+        problem_score = self.session.problem_score
+        for length in range(len(solution)):
+            self.assertFalse(self.session.check_typed(solution[:length]))
+        self.assertFalse(self.session.check_typed(solution + "0"))
+        self.assertEqual(self.session.answered, 0)
+        self.assertTrue(self.session.check_typed(solution))
+        self.assertEqual(
+            (self.session.answered, self.session.score), (1, problem_score)
+        )
+
+    def test_keystroke_budget(self):
+        result = bench_keystrokes(keystrokes=2000, repeats=3)[0]
+        self.assertLess(result["mean"], keystroke_budget)
+
+    def test_timer(self):
+        self.now = 110.0
+        self.assertTrue(self.session.tick())
+        self.assertEqual(self.session.time_left(), 10.0)
+        self.now = 120.0
+        self.assertFalse(self.session.tick())
+        # Answers after time is up do not count
+        self.assertFalse(self.session.submit(str(self.session.solution)))
+        self.assertEqual(self.session.score, 0)
+
+    def test_ticks_land_on_the_deadline(self):
+        self.assertEqual(self.session.seconds_left(), 20)
+        self.assertEqual(self.session.next_tick(), 1.0)
+        self.now = 100.3
+        self.assertEqual(self.session.seconds_left(), 20)
+        self.assertAlmostEqual(self.session.next_tick(), 0.7)
+        # However late each tick runs, the next one is scheduled from the deadline
+        now = 100.0
+        ticks = 0
+        while self.session.tick(now):
+            now += self.session.next_tick(now) + 0.013
+            ticks += 1
+        self.assertEqual(ticks, 20)
+        self.assertAlmostEqual(now, 120.013)
+
+    def test_simulate_session(self):
+        result = simulate_session(seed=1, accuracy=1.0, seconds_per_answer=2.0)
+        self.assertEqual(result.answered, 59)
+        self.assertEqual(result.answered, result.correct)
+        self.assertEqual(
+            result, simulate_session(seed=1, accuracy=1.0, seconds_per_answer=2.0)
+        )
+
+    def test_simulate_sessions(self):
+        seeds = [1, 2, 3]
+        self.assertEqual(
+            simulate_sessions(seeds, processes=2, accuracy=0.7),
+            [simulate_session(seed, accuracy=0.7) for seed in seeds],
+        )
+
+    def test_injected_rng_replays_the_game(self):
+        # Also with reviews, which are all due right away on this clock
+        for review in (False, True):
+            sessions = [
+                GameSession(
+                    "tester",
+                    clock=None,
+                    rng=np.random.default_rng(32),
+                    review=ReviewQueue(clock=lambda: 1e9) if review else None,
+                )
+                for _ in range(2)
+            ]
+            for session in sessions:
+                session.start(0.0)
+            for second in range(1, 301):
+                self.assertEqual(sessions[0].problem, sessions[1].problem)
+                for session in sessions:
+                    session.submit("", float(second))
+
+    def test_unstarted_session_is_not_running(self):
+        session = GameSession("tester", clock=lambda: self.now, seed=3)
+        self.assertFalse(session.tick())
+        self.assertFalse(session.submit("1"))
+        self.assertEqual(session.time_left(), 20.0)
+        self.assertEqual((session.answered, session.finished), (0, False))
+        session.start()
+        self.assertTrue(session.tick())
+
+    def test_scheduler_learns_from_answers(self):
+        stats = TypeStats()
+        session = GameSession("tester", clock=None, seed=3, scheduler=stats)
+        session.start(0.0)
+        for second in range(1, 11):
+            session.submit(str(session.solution), float(second))
+        self.assertEqual(stats.answers.sum(), 10)
+        self.assertEqual(session.problems.scheduler, stats)
+
+    def test_expression_problems(self):
+        session = GameSession("tester", clock=None, seed=3, expression_depth=3)
+        session.start(0.0)
+        self.assertIsNone(session.problem.type)
+        self.assertGreaterEqual(session.problem_score, 3)
+        self.assertTrue(session.submit(str(session.solution), 1.0))
+        for depth in (0, -1):
+            with self.assertRaises(ValueError):
+                GameSession("tester", clock=None, seed=3, expression_depth=depth)
+
+    def test_problem_index(self):
+        session = GameSession(
+            "tester",
+            time_limit=1000,
+            clock=None,
+            seed=3,
+            index=ProblemIndex(build_index()),
+        )
+        session.start(0.0)
+        strings = []
+        for i in range(100):
+            strings.append(session.problem_string)
+            session.submit(str(session.solution), i + 1.0)
+        self.assertEqual(len(set(strings)), 100)
+
+    def test_first_problem_without_numpy_queue(self):
+        session = GameSession("tester", clock=None, seed=7)
+        session.start(0.0)
+        self.assertIsNone(session.problems.queue)
+        self.assertEqual(session.problem, draw_problem(random.Random(7)))
+        session.submit("", 1.0)
+        self.assertIsNotNone(session.problems.queue)
+
+    def test_seeded_sessions_are_reproducible(self):
+        first, second = GameSession("a", seed=5), GameSession("b", seed=5)
+        first.start(0.0)
+        second.start(0.0)
+        for _ in range(300):
+            self.assertEqual(first.problem, second.problem)
+            first.submit("", 1.0)
+            second.submit("", 1.0)
+        self.assertIsNotNone(GameSession("c").seed)
+        with self.assertRaises(ValueError):
+            GameSession("d", seed=-1)
+
+
+# Use unittest to test generate_problem method, specifically making sure that the solution is always a non-negative integer
+# The game engine is headless, so no Tkinter window is needed for this
+class TestGenerateProblem(unittest.TestCase):
+    def setUp(self):
+        self.session = GameSession(username="tester")
+
+    def test_generate_problem(self):
+        for _ in range(10000):
+            _, solution, _ = self.session.generate_problem()
+            self.assertGreaterEqual(solution, 0, "Solution is negative")
+            self.assertIsInstance(solution, int, "Solution is not an integer")
+
+
+# Use unittest to test that draw_problem follows the same rules as generate_batch, one problem at a time in plain Python
+class TestDrawProblem(unittest.TestCase):
+    def test_solutions_match_problem_strings(self):
+        rng = random.Random(32)
+        problems = [draw_problem(rng) for _ in range(5000)]
+        problems += [
+            draw_problem(rng, problem_type)
+            for problem_type in range(len(problem_templates))
+            for _ in range(50)
+        ]
+        solutions = solve_batch(
+            [problem.type for problem in problems],
+            [problem.operands for problem in problems],
+        )
+        for problem, solution in zip(problems, solutions.tolist()):
+            self.assertEqual(problem.solution, solution, problem.string)
+            self.assertGreaterEqual(problem.solution, 0, problem.string)
+            expression = (
+                problem.string.rstrip("= ").replace("x", "*").replace("^", "**")
+            )
+            self.assertEqual(eval(expression.replace("/", "//")), solution)
+
+
+# Use unittest to test the startup budget: importing UltraMac.py must not import any of the deferred modules, and has to stay under startup_budget
+class TestStartup(unittest.TestCase):
+    def test_startup_imports(self):
+        times = import_times("UltraMac")
+        for module in deferred_modules:
+            self.assertNotIn(module, times)
+        self.assertLess(times["UltraMac"], startup_budget)